@@ -16,6 +16,9 @@ DATA_FILE = os.path.join(INPUT_DIR, 'hansard_justnine_12192019.csv')
 
 CHUNK_SIZE = 2**15
 
+# Bytes of DATA_FILE read by a worker at once with --parallel-read, about CHUNK_SIZE rows.
+CHUNK_BYTES = 2**21
+
 
 def cleanse_string(s):
     # Cleanse string from trailing and leading white space.
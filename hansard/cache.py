@@ -0,0 +1,471 @@
+import hashlib
+import pickle
+import sqlite3
+import sys
+from bisect import bisect_right
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class LRUMemo:
+    """Memoizes a single argument function, evicting the least recently used entry once `max_size` is reached."""
+
+    def __init__(self, func: Callable[[Hashable], Any], max_size: int):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+
+        self.func = func
+        self.max_size = max_size
+        self._store: 'OrderedDict[Hashable, Any]' = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, key: Hashable) -> Any:
+        store = self._store
+        try:
+            value = store[key]
+        except KeyError:
+            pass
+        else:
+            store.move_to_end(key)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = self.func(key)
+        store[key] = value
+        if len(store) > self.max_size:
+            store.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def __len__(self):
+        return len(self._store)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._store)}
+
+
+def estimate_size(value: Any) -> int:
+    # Rough bytes held by a value, counting the items of tuples and lists (one level deep) along with them.
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+class SLRUCache:
+    """
+    A mapping kept within a memory budget by segmented LRU eviction.
+
+    New keys enter the probation segment and move to the protected segment when they are looked up again, so keys
+    used once cannot push out the ones used repeatedly. The protected segment holds at most `protected_share` of
+    the budget, its least recently used keys drop back to probation. Once over the budget the least recently used
+    probation keys are evicted first. Sizes are estimated bytes given with every put.
+    """
+
+    def __init__(self, max_bytes: int, protected_share: float = 0.8,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        if max_bytes <= 0:
+            raise ValueError('max_bytes must be positive')
+
+        self.max_bytes = max_bytes
+        self.max_protected_bytes = int(max_bytes * protected_share)
+        self.on_evict = on_evict
+
+        # key -> (value, size)
+        self._probation: 'OrderedDict[Hashable, Tuple[Any, int]]' = OrderedDict()
+        self._protected: 'OrderedDict[Hashable, Tuple[Any, int]]' = OrderedDict()
+        self._protected_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        protected = self._protected
+        entry = protected.get(key)
+        if entry is not None:
+            protected.move_to_end(key)
+        else:
+            entry = self._probation.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            protected[key] = entry
+            self._protected_bytes += entry[1]
+            self._demote()
+
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int):
+        entry = self._protected.get(key)
+        if entry is not None:
+            self._protected[key] = (value, size)
+            self._protected.move_to_end(key)
+            self._protected_bytes += size - entry[1]
+            self._demote()
+        else:
+            entry = self._probation.pop(key, None)
+            self._probation[key] = (value, size)
+
+        self.bytes += size - (entry[1] if entry is not None else 0)
+        self._evict()
+
+    def peek(self, key: Hashable) -> Optional[Tuple[Any, int]]:
+        # The (value, size) of key, without counting a lookup or changing its recency.
+        entry = self._protected.get(key)
+        return entry if entry is not None else self._probation.get(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._protected or key in self._probation
+
+    def __len__(self):
+        return len(self._protected) + len(self._probation)
+
+    def _demote(self):
+        protected = self._protected
+        while self._protected_bytes > self.max_protected_bytes and len(protected) > 1:
+            key, entry = protected.popitem(last=False)
+            self._protected_bytes -= entry[1]
+            self._probation[key] = entry
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self) > 1:
+            segment = self._probation if self._probation else self._protected
+            key, (value, size) = segment.popitem(last=False)
+            if segment is self._protected:
+                self._protected_bytes -= size
+            self.bytes -= size
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'bytes': self.bytes,
+                'size': len(self)}
+
+
+class IntervalCache:
+    """
+    Caches a value per key together with the [start, end) dates it holds for, so a lookup for any date inside a
+    stored window is a hit. Dates are int64 nanoseconds (see DateWindow), and the windows of a key must not overlap.
+
+    The windows are kept in an SLRUCache by key, the windows of a key are evicted together.
+    """
+
+    # Estimated bytes for the containers of a key, and for each window on top of its value.
+    KEY_OVERHEAD = 256
+    WINDOW_OVERHEAD = 128
+
+    def __init__(self, max_bytes: int):
+        # key -> (window starts in order, (window end, value) for each of them)
+        self._windows = SLRUCache(max_bytes, on_evict=self._evicted)
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def _evicted(self, key: Hashable, windows: Tuple[List[int], List[Tuple[int, Any]]]):
+        self._size -= len(windows[0])
+
+    def get(self, key: Hashable, date: int, default: Any = None) -> Any:
+        windows = self._windows.get(key)
+        if windows is not None:
+            starts, entries = windows
+            i = bisect_right(starts, date) - 1
+            if i >= 0:
+                end, value = entries[i]
+                if date < end:
+                    self.hits += 1
+                    return value
+
+        self.misses += 1
+        return default
+
+    def put(self, key: Hashable, start: int, end: int, value: Any):
+        size = self.WINDOW_OVERHEAD + estimate_size(value)
+        entry = self._windows.peek(key)
+        if entry is None:
+            windows = ([], [])
+            size += self.KEY_OVERHEAD + sys.getsizeof(key)
+        else:
+            windows, key_size = entry
+            size += key_size
+
+        starts, entries = windows
+        i = bisect_right(starts, start)
+        starts.insert(i, start)
+        entries.insert(i, (end, value))
+        self._size += 1
+        self._windows.put(key, windows, size)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self._windows.evictions,
+                'bytes': self._windows.bytes, 'size': self._size}
+
+
+class SQLiteCache:
+    """
+    Base for the caches kept in a SQLite file, which several processes can use at once.
+
+    Each process connects on first use, so the object can be handed to worker processes before any lookup. The
+    counters only cover the lookups and inserts made by the current process.
+    """
+
+    TABLES: Tuple[str, ...] = ()
+    COUNTERS: Tuple[str, ...] = ('hits', 'misses', 'inserts')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: Optional[sqlite3.Connection] = None
+
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+
+    def __getstate__(self):
+        # The copy in another process starts without a connection and with its own counters.
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state.update(dict.fromkeys(self.COUNTERS, 0))
+        return state
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            for table in self.TABLES:
+                connection.execute(table)
+            self._connection = connection
+        return self._connection
+
+    def _get_window(self, key: str, date: int) -> Optional[Tuple[int, int, Any]]:
+        row = self._connect().execute('SELECT start, end, value FROM windows WHERE key = ? AND start <= ? '
+                                      'ORDER BY start DESC LIMIT 1', (key, date)).fetchone()
+        if row is not None and date < row[1]:
+            self.hits += 1
+            return row[0], row[1], pickle.loads(row[2])
+
+        self.misses += 1
+        return None
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def stats(self) -> Dict[str, int]:
+        return {counter: getattr(self, counter) for counter in self.COUNTERS}
+
+
+class SharedIntervalCache(SQLiteCache):
+    """
+    An IntervalCache shared by every worker process through a SQLite file.
+
+    Once more than `max_size` windows are stored, the oldest inserted ones are evicted, `evict_batch` (by default a
+    sixteenth of max_size) at a time so that evicting is not part of every insert.
+    """
+
+    TABLES = ('CREATE TABLE IF NOT EXISTS windows '
+              '(key TEXT, start INTEGER, end INTEGER, value BLOB, PRIMARY KEY (key, start))', )
+    COUNTERS = ('hits', 'misses', 'inserts', 'evictions')
+
+    def __init__(self, path: str, max_size: int, evict_batch: Optional[int] = None):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+
+        super().__init__(path)
+        self.max_size = max_size
+        self.evict_batch = evict_batch if evict_batch is not None else max(max_size // 16, 1)
+
+    def get(self, key: str, date: int) -> Optional[Tuple[int, int, Any]]:
+        # The (start, end, value) window of key containing date.
+        return self._get_window(key, date)
+
+    def put(self, key: str, start: int, end: int, value: Any):
+        connection = self._connect()
+        cursor = connection.execute('INSERT OR IGNORE INTO windows VALUES (?, ?, ?, ?)',
+                                    (key, start, end, pickle.dumps(value)))
+        if not cursor.rowcount:
+            # Another process stored the same window first.
+            return
+        self.inserts += 1
+
+        # Only the oldest rows are ever deleted, so the rowids still stored are contiguous.
+        lowest, highest = connection.execute('SELECT min(rowid), max(rowid) FROM windows').fetchone()
+        if highest - lowest + 1 > self.max_size:
+            keep = max(self.max_size - self.evict_batch, 1)
+            cursor = connection.execute('DELETE FROM windows WHERE rowid <= ?', (highest - keep, ))
+            self.evictions += cursor.rowcount
+
+
+class PersistentResolutionCache(SQLiteCache):
+    """
+    Resolutions kept on disk from one run to the next.
+
+    Entries are either a date window of a key, as in IntervalCache, or the result for one exact (key, date, context).
+    Every entry lists the data sources it was worked out from. `invalidate` is given the current version (content
+    hash) of every source and drops the entries depending on a source whose version changed since the last run.
+    """
+
+    TABLES = (
+        'CREATE TABLE IF NOT EXISTS windows '
+        '(key TEXT, start INTEGER, end INTEGER, value BLOB, sources TEXT, PRIMARY KEY (key, start))',
+        'CREATE TABLE IF NOT EXISTS contexts '
+        '(key TEXT, date INTEGER, context TEXT, value BLOB, sources TEXT, PRIMARY KEY (key, date, context))',
+        'CREATE TABLE IF NOT EXISTS versions (source TEXT PRIMARY KEY, version TEXT)',
+    )
+
+    def invalidate(self, versions: Dict[str, str]) -> List[str]:
+        # Returns the sources whose version changed.
+        connection = self._connect()
+        stored = dict(connection.execute('SELECT source, version FROM versions'))
+        changed = sorted(source for source in stored.keys() | versions.keys()
+                         if stored.get(source) != versions.get(source))
+
+        connection.execute('BEGIN IMMEDIATE')
+        for source in changed:
+            for table in ('windows', 'contexts'):
+                connection.execute(f'DELETE FROM {table} WHERE instr(sources, ?)', (f',{source},', ))
+        connection.execute('DELETE FROM versions')
+        connection.executemany('INSERT INTO versions VALUES (?, ?)', versions.items())
+        connection.execute('COMMIT')
+        return changed
+
+    def get(self, key: str, date: int) -> Optional[Tuple[int, int, Any]]:
+        # The (start, end, value) window of key containing date.
+        return self._get_window(key, date)
+
+    def get_context(self, key: str, date: int, context: str) -> Optional[Any]:
+        row = self._connect().execute('SELECT value FROM contexts WHERE key = ? AND date = ? AND context = ?',
+                                      (key, date, context)).fetchone()
+        if row is not None:
+            self.hits += 1
+            return pickle.loads(row[0])
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, start: int, end: int, value: Any, sources: Iterable[str]):
+        cursor = self._connect().execute('INSERT OR IGNORE INTO windows VALUES (?, ?, ?, ?, ?)',
+                                         (key, start, end, pickle.dumps(value), _join_sources(sources)))
+        self.inserts += cursor.rowcount
+
+    def put_context(self, key: str, date: int, context: str, value: Any, sources: Iterable[str]):
+        cursor = self._connect().execute('INSERT OR IGNORE INTO contexts VALUES (?, ?, ?, ?, ?)',
+                                         (key, date, context, pickle.dumps(value), _join_sources(sources)))
+        self.inserts += cursor.rowcount
+
+
+def _join_sources(sources: Iterable[str]) -> str:
+    # Delimited on both sides so a source can be found with instr().
+    return ',' + ','.join(sorted(sources)) + ','
+
+
+class BloomFilter:
+    """
+    A Bloom filter over strings with its bits in shared memory, read and set by every process it is handed to. A
+    forked process inherits the mapping, a copy pickled to a spawned process attaches to the memory by name. Bits
+    are set without a lock, so two processes adding at once can lose one of the adds. That only makes a later lookup
+    of the lost string a negative, never a false positive.
+    """
+
+    def __init__(self, num_bits: int, num_hashes: int = 7):
+        if num_bits <= 0:
+            raise ValueError('num_bits must be positive')
+
+        self.num_bytes = (num_bits + 7) // 8
+        self.num_bits = self.num_bytes * 8
+        self.num_hashes = num_hashes
+
+        self._memory = shared_memory.SharedMemory(create=True, size=self.num_bytes)
+        self._bits = self._memory.buf
+        self._bits[:self.num_bytes] = bytes(self.num_bytes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_memory'], state['_bits']
+        state['name'] = self._memory.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop('name')
+        self.__dict__.update(state)
+        self._memory = shared_memory.SharedMemory(name=name)
+        self._bits = self._memory.buf
+
+    def _positions(self, value: str) -> List[int]:
+        # Double hashing of a single 128 bit digest.
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value: str):
+        bits = self._bits
+        for position in self._positions(value):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] >> (position & 7) & 1 for position in self._positions(value))
+
+    def close(self):
+        self._bits.release()
+        self._memory.close()
+
+    def unlink(self):
+        # Frees the shared memory, called once by the process that created the filter.
+        self._memory.unlink()
+
+
+class NegativeCache(SQLiteCache):
+    """
+    Strings found to resolve to nothing on every date, shared by every worker process.
+
+    The strings are stored in a SQLite file, with a BloomFilter in shared memory in front of it. Most lookups of
+    other strings are answered by the filter alone, a positive answer is confirmed against the file so a false
+    positive only costs that query.
+    """
+
+    TABLES = ('CREATE TABLE IF NOT EXISTS negatives (value TEXT PRIMARY KEY)', )
+    COUNTERS = ('hits', 'misses', 'inserts', 'false_positives')
+
+    def __init__(self, path: str, num_bits: int):
+        super().__init__(path)
+        self.filter = BloomFilter(num_bits)
+
+    def __contains__(self, value: str) -> bool:
+        if value in self.filter:
+            if self._connect().execute('SELECT 1 FROM negatives WHERE value = ?', (value, )).fetchone():
+                self.hits += 1
+                return True
+            self.false_positives += 1
+
+        self.misses += 1
+        return False
+
+    def add(self, value: str):
+        cursor = self._connect().execute('INSERT OR IGNORE INTO negatives VALUES (?)', (value, ))
+        self.inserts += cursor.rowcount
+        # Set the bits once the row is stored, so every positive can be confirmed.
+        self.filter.add(value)
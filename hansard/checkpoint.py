@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+def file_digest(path: str, block_size: int = 2**20) -> str:
+    # Digest of the whole file, read block by block.
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def runs(sequences: Iterable[int]) -> List[Tuple[int, int]]:
+    # Sequence numbers as sorted [start, end) runs, a single run when chunks are written in order.
+    merged = []
+    for sequence in sorted(sequences):
+        if merged and merged[-1][1] == sequence:
+            merged[-1] = (merged[-1][0], sequence + 1)
+        else:
+            merged.append((sequence, sequence + 1))
+    return merged
+
+
+class Checkpoint:
+    """
+    The input chunks (by sequence number) of a run written durably to its output file, and the size of the file
+    once they were, kept in a JSON file next to the output.
+
+    `layout` describes what the sequence numbers and rows depend on (input file, chunking, output columns, data and
+    rules versions). A run is only resumed from a checkpoint with the same layout, after cutting the output back to
+    the recorded size: whatever was appended after the last save is written again.
+    """
+
+    def __init__(self, output_path: str, layout: Dict[str, object]):
+        self.output_path = output_path
+        self.path = f'{output_path}.checkpoint'
+        self.layout = layout
+
+        self.written: Set[int] = set()
+        self.size = 0
+
+    def resume(self) -> bool:
+        # Picks up the chunks written by the last run, False when there is nothing to resume.
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            saved = json.load(f)
+
+        changed = sorted(key for key in set(saved['layout']) | set(self.layout)
+                         if saved['layout'].get(key) != self.layout.get(key))
+        if changed:
+            raise ValueError(f'Cannot resume, the run changed since the checkpoint: {", ".join(changed)}')
+        if not os.path.exists(self.output_path) or os.path.getsize(self.output_path) < saved['size']:
+            raise ValueError(f'Cannot resume, {self.output_path} is shorter than the checkpoint')
+
+        self.written = {sequence for start, end in saved['written'] for sequence in range(start, end)}
+        self.size = saved['size']
+        return True
+
+    def record(self, sequence: int, size: int):
+        # Called once the chunk is written, leaving the output size at size. Only saved by the next save.
+        self.written.add(sequence)
+        self.size = size
+
+    def save(self):
+        # The output must be flushed to disk up to size first.
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'layout': self.layout, 'size': self.size, 'written': runs(self.written)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
@@ -0,0 +1,225 @@
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Pattern, Set, Tuple
+
+from hansard.index import AhoCorasick
+
+
+_REGEX_SPECIAL = '.^$*+?{}[]\\|()'
+
+
+def _can_create(pattern: str, replacement: str) -> bool:
+    # Whether writing `replacement` into a string could produce a new occurrence of `pattern`.
+    # A new occurrence must overlap the inserted text, so `pattern` has to share a prefix/suffix with it.
+    if not replacement:
+        # Deleting text joins its neighbours together, anything could appear across the seam.
+        return True
+
+    if pattern in replacement or replacement in pattern:
+        return True
+
+    for k in range(1, min(len(pattern), len(replacement)) + 1):
+        if pattern.endswith(replacement[:k]) or pattern.startswith(replacement[-k:]):
+            return True
+
+    return False
+
+
+class LiteralCorrector:
+    """
+    Applies an ordered list of literal (incorrect, correct) replacements with a single Aho-Corasick scan.
+
+    The output is identical to running `s = s.replace(incorrect, correct)` for every rule in list order:
+      - Rules are still applied in list order, and every occurrence of a rule is replaced (like str.replace,
+        occurrences are found left to right and do not overlap each other).
+      - A scan of the input finds every rule whose pattern occurs in it, including overlapping and nested
+        occurrences. Rules whose pattern does not occur are skipped as they would be a no-op.
+      - A rule can create an occurrence of a later rule's pattern (e.g. 'By Mr. Robinson.' -> 'Mr. Robinson').
+        These chains are worked out once at compile time, so a matched rule also schedules every later rule its
+        replacement could produce. Overlapping rules that destroy each other's matches are handled by the
+        ordered replacement itself.
+    """
+
+    def __init__(self, corrections: Iterable[Tuple[str, str]]):
+        self.corrections: List[Tuple[str, str]] = list(corrections)
+
+        self._automaton = AhoCorasick(pattern for pattern, _ in self.corrections)
+        self._closure: List[FrozenSet[int]] = self._build_closure()
+
+    def _build_closure(self) -> List[FrozenSet[int]]:
+        closure: List[FrozenSet[int]] = [frozenset()] * len(self.corrections)
+
+        # Later rules only depend on rules after them, so fill from the end.
+        for i in range(len(self.corrections) - 1, -1, -1):
+            replacement = self.corrections[i][1]
+            rules = {i}
+            for j in range(i + 1, len(self.corrections)):
+                if j not in rules and _can_create(self.corrections[j][0], replacement):
+                    rules.update(closure[j])
+            closure[i] = frozenset(rules)
+
+        return closure
+
+    def find(self, string_val: str) -> Set[int]:
+        return self._automaton.find(string_val)
+
+    def apply(self, string_val: str) -> str:
+        found = self.find(string_val)
+        if not found:
+            return string_val
+
+        rules = set()
+        for index in found:
+            rules.update(self._closure[index])
+
+        for index in sorted(rules):
+            incorrect, correct = self.corrections[index]
+            string_val = string_val.replace(incorrect, correct)
+        return string_val
+
+
+def _has_top_level_alternation(pattern: str) -> bool:
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            i += 2
+            continue
+        if ch == '[':
+            # Skip the character class. A ']' right after '[' or '[^' is a literal.
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == '|' and not depth:
+            return True
+        i += 1
+    return False
+
+
+def _literal_prefix(pattern: str) -> str:
+    # Literal text every match of a '^' anchored pattern has to start with.
+    if not pattern.startswith('^') or _has_top_level_alternation(pattern):
+        return ''
+
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break
+            literal, step = pattern[i + 1], 2
+        elif ch in _REGEX_SPECIAL:
+            break
+        else:
+            literal, step = ch, 1
+
+        quantifier = pattern[i + step:i + step + 1]
+        if quantifier and quantifier in '*?{':
+            # The character is optional.
+            break
+        prefix.append(literal)
+        if quantifier == '+':
+            break
+        i += step
+
+    return ''.join(prefix)
+
+
+def _is_gate_safe(pattern: str) -> bool:
+    # Patterns that keep their meaning when wrapped into a combined alternation.
+    return re.search(r'\\\d|\(\?[^:]', pattern) is None
+
+
+class RegexCorrector:
+    """
+    Applies an ordered list of (compiled regex, replacement) rules, equivalent to calling `re.sub` for every rule.
+
+    Most rules are anchored ('^word +'), so they can only fire when the string starts with their literal prefix.
+    Those rules are indexed in a prefix trie and only looked at when the current string walks through their node.
+    The remaining rules are guarded by a single combined alternation: if it finds nothing, none of them can match.
+    Whenever a rule changes the string, the candidates for the rules after it are worked out again.
+    """
+
+    def __init__(self, corrections: Iterable[Tuple[Pattern, str]]):
+        self.corrections: List[Tuple[Pattern, str]] = list(corrections)
+
+        self._children: List[Dict[str, int]] = [{}]
+        self._node_rules: List[List[int]] = [[]]
+
+        # Unanchored rules behind the combined alternation, and rules that have to be tried every time.
+        self._gated: List[int] = []
+        self._always: List[int] = []
+
+        # Gated rules without any regex syntax, these are checked with a plain substring test.
+        self._literals: Dict[int, str] = {}
+
+        default_flags = re.compile('').flags
+        gate_patterns = []
+
+        for index, (regex, _) in enumerate(self.corrections):
+            prefix = _literal_prefix(regex.pattern) if regex.flags == default_flags else ''
+            if prefix:
+                self._add_prefix(prefix, index)
+            elif regex.flags == default_flags and _is_gate_safe(regex.pattern):
+                self._gated.append(index)
+                gate_patterns.append(f'(?:{regex.pattern})')
+                if not any(ch in _REGEX_SPECIAL for ch in regex.pattern):
+                    self._literals[index] = regex.pattern
+            else:
+                self._always.append(index)
+
+        self._gate: Optional[Pattern] = re.compile('|'.join(gate_patterns)) if gate_patterns else None
+
+    def _add_prefix(self, prefix: str, index: int):
+        node = 0
+        for ch in prefix:
+            next_node = self._children[node].get(ch)
+            if next_node is None:
+                next_node = len(self._children)
+                self._children[node][ch] = next_node
+                self._children.append({})
+                self._node_rules.append([])
+            node = next_node
+        self._node_rules[node].append(index)
+
+    def candidates(self, string_val: str, start: int = 0) -> List[int]:
+        rules = [index for index in self._always if index >= start]
+
+        if self._gated and self._gated[-1] >= start and self._gate.search(string_val):
+            literals = self._literals
+            rules.extend(index for index in self._gated
+                         if index >= start and (index not in literals or literals[index] in string_val))
+
+        node = 0
+        for ch in string_val:
+            node = self._children[node].get(ch)
+            if node is None:
+                break
+            rules.extend(index for index in self._node_rules[node] if index >= start)
+
+        rules.sort()
+        return rules
+
+    def apply(self, string_val: str) -> str:
+        rules = self.candidates(string_val)
+        i = 0
+        while i < len(rules):
+            index = rules[i]
+            regex, replacement = self.corrections[index]
+            new_val = regex.sub(replacement, string_val)
+            if new_val != string_val:
+                string_val = new_val
+                rules = self.candidates(string_val, index + 1)
+                i = 0
+            else:
+                i += 1
+        return string_val
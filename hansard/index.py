@@ -0,0 +1,568 @@
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy
+import pandas as pd
+
+from hansard.speaker import Office
+from util.edit_distance import PackedAliases, within_distance_batch
+from util.jaro_distance import JaroScorer
+
+
+_EMPTY_POSTING: Set[int] = frozenset()
+
+
+def _nanoseconds(dates: numpy.ndarray) -> numpy.ndarray:
+    # datetime64 values as int64 nanoseconds, NaT becomes the smallest int64.
+    return numpy.asarray(dates, dtype='datetime64[ns]').view('int64')
+
+
+class DateWindow:
+    """
+    The [start, end) dates around `date` over which every lookup recorded into it gives the same answer.
+
+    A lookup filtering rows by date records the dates where its answer could change (the start and end of every
+    row it considered). A result worked out from recorded lookups only is then the same for any date in the window.
+    Dates are kept as int64 nanoseconds.
+    """
+
+    def __init__(self, date: datetime):
+        self.date: int = pd.Timestamp(date).value
+        self.start: int = numpy.iinfo(numpy.int64).min
+        self.end: int = numpy.iinfo(numpy.int64).max
+        self.collapsed = False
+
+    def add_breakpoint(self, point: int):
+        if point <= self.date:
+            if point > self.start:
+                self.start = point
+        elif point < self.end:
+            self.end = point
+
+    def add_interval(self, start: datetime, end: datetime, closed: bool = False):
+        # Something true from start up to end, end included when closed.
+        self.add_breakpoint(pd.Timestamp(start).value)
+        self.add_breakpoint(pd.Timestamp(end).value + closed)
+
+    def add_intervals(self, starts: numpy.ndarray, ends: numpy.ndarray):
+        # Rows matching the dates in [starts[i], ends[i]). Missing dates never match, they can be ignored.
+        for points in (_nanoseconds(starts), _nanoseconds(ends)):
+            earlier = points[points <= self.date]
+            if len(earlier):
+                self.add_breakpoint(int(earlier.max()))
+            later = points[points > self.date]
+            if len(later):
+                self.add_breakpoint(int(later.min()))
+
+    @property
+    def unbounded(self) -> bool:
+        # No lookup recorded a date where its answer changes, the answer is the same on every date.
+        return self.start == numpy.iinfo(numpy.int64).min and self.end == numpy.iinfo(numpy.int64).max
+
+    def collapse(self):
+        # The answer depends on more than the date, it only holds for the date itself.
+        self.start = self.date
+        self.end = self.date + 1
+        self.collapsed = True
+
+    def __contains__(self, date: datetime) -> bool:
+        return self.start <= pd.Timestamp(date).value < self.end
+
+
+class AhoCorasick:
+    """Finds which of a fixed set of non-empty patterns occur in a string, with a single scan of the string."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                raise ValueError(f'Empty pattern at index {index}')
+            self._add_pattern(pattern, index)
+
+        self._build_failure_links()
+
+    def _add_pattern(self, pattern: str, index: int):
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (index, )
+
+    def _build_failure_links(self):
+        goto, fail, out = self._goto, self._fail, self._out
+
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, next_state in goto[state].items():
+                queue.append(next_state)
+
+                fallback = fail[state]
+                while fallback and ch not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(ch, 0)
+                out[next_state] += out[fail[next_state]]
+
+    def find(self, string_val: str) -> Set[int]:
+        # Indices of every pattern occurring in string_val, overlapping and nested occurrences included.
+        goto, fail, out = self._goto, self._fail, self._out
+
+        found = set()
+        state = 0
+        for ch in string_val:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class NGramIndex:
+    """
+    Finds which of a fixed list of strings contain a target, through an inverted index of their n-grams.
+
+    Every value is split into its n-grams (of length 1 up to n). A target of at most n characters is looked up
+    directly, a longer target intersects the values sharing all of its n-grams and checks those for containment.
+    """
+
+    def __init__(self, values: Iterable[str], n: int = 3):
+        self.values: List[str] = list(values)
+        self.n = n
+
+        self._grams: Dict[str, Set[int]] = {}
+        for position, value in enumerate(self.values):
+            for size in range(1, n + 1):
+                for i in range(len(value) - size + 1):
+                    self._grams.setdefault(value[i:i + size], set()).add(position)
+
+    def posting(self, gram: str) -> Set[int]:
+        # Positions of every value containing a gram of at most n characters.
+        return self._grams.get(gram, _EMPTY_POSTING)
+
+    def containing(self, target: str) -> Set[int]:
+        # Positions of every value containing target.
+        if not target:
+            return set(range(len(self.values)))
+
+        n = self.n
+        if len(target) <= n:
+            return set(self._grams.get(target, ()))
+
+        postings = []
+        for gram in {target[i:i + n] for i in range(len(target) - n + 1)}:
+            posting = self._grams.get(gram)
+            if posting is None:
+                return set()
+            postings.append(posting)
+
+        postings.sort(key=len)
+        positions = postings[0].intersection(*postings[1:])
+
+        values = self.values
+        return {position for position in positions if target in values[position]}
+
+
+class DatedAliasIndex:
+    """
+    Rows of a frame with an alias within `max_edits` of a target and a [start, end) search window containing a date.
+
+    The aliases of every row, whatever their dates, go through one EditDistanceIndex and the rows it accepts are
+    then filtered by date. The search windows of the accepted rows bound the dates the answer holds for.
+    """
+
+    def __init__(self, df: pd.DataFrame, column: str = 'alias', start_column: str = 'start_search',
+                 end_column: str = 'end_search', id_column: str = 'corresponding_id', max_edits: int = 2):
+        self.values: List[str] = list(df[column])
+        self.fuzzy = EditDistanceIndex(self.values, max_edits)
+        self.ids: numpy.ndarray = df[id_column].to_numpy(dtype=float)
+        self.starts: numpy.ndarray = df[start_column].to_numpy()
+        self.ends: numpy.ndarray = df[end_column].to_numpy()
+
+    def positions(self, target: str, date: datetime, window: Optional[DateWindow] = None) -> List[int]:
+        # Positions of the matching rows, in row order.
+        accepted = numpy.array(self.fuzzy.positions(target), dtype=int)
+        starts, ends = self.starts[accepted], self.ends[accepted]
+        if window is not None:
+            window.add_intervals(starts, ends)
+        date = numpy.datetime64(date)
+        return accepted[(date >= starts) & (date < ends)].tolist()
+
+
+class DateIntervalIndex:
+    """
+    Answers `df[(date >= df[start]) & (date < df[end]) & df[key].isin(keys)]` for rows grouped by a key column.
+
+    For each key the start/end dates are merged into a sorted list of breakpoints, and every breakpoint stores the
+    rows whose interval covers the segment starting there. A lookup is a bisect per key.
+    """
+
+    def __init__(self, df: pd.DataFrame, key_column: str, start_column: str = 'start_search',
+                 end_column: str = 'end_search'):
+        self.df = df
+
+        # key -> (breakpoints, row positions active from each breakpoint up to the next one)
+        self._segments: Dict[object, Tuple[List[pd.Timestamp], List[Tuple[int, ...]]]] = {}
+
+        intervals: Dict[object, List[Tuple[pd.Timestamp, pd.Timestamp, int]]] = {}
+        for position, (key, start, end) in enumerate(zip(df[key_column], df[start_column], df[end_column])):
+            if pd.isna(start) or pd.isna(end) or not start < end:
+                # Never matches a date.
+                continue
+            intervals.setdefault(key, []).append((start, end, position))
+
+        for key, key_intervals in intervals.items():
+            breakpoints = sorted({date for start, end, _ in key_intervals for date in (start, end)})
+            active = [tuple(position for start, end, position in key_intervals if start <= point < end)
+                      for point in breakpoints]
+            self._segments[key] = (breakpoints, active)
+
+        self._empty = df.iloc[0:0]
+
+    def positions(self, keys: Iterable, date: datetime, window: Optional[DateWindow] = None) -> List[int]:
+        positions = set()
+        for key in keys:
+            segments = self._segments.get(key)
+            if segments is None:
+                continue
+            breakpoints, active = segments
+            i = bisect_right(breakpoints, date)
+            if window is not None:
+                # The active rows are the same up to the neighbouring breakpoints.
+                if i:
+                    window.add_breakpoint(breakpoints[i - 1].value)
+                if i < len(breakpoints):
+                    window.add_breakpoint(breakpoints[i].value)
+            if i:
+                positions.update(active[i - 1])
+        return sorted(positions)
+
+    def query(self, keys: Iterable, date: datetime, window: Optional[DateWindow] = None) -> pd.DataFrame:
+        positions = self.positions(keys, date, window)
+        if not positions:
+            return self._empty
+        return self.df.iloc[positions]
+
+
+def levenshtein_bound(max_edits: int) -> int:
+    # Largest Levenshtein distance the greedy kernels in util.edit_distance accept for an edit limit. When the
+    # longer string runs out first after m skips, the kernel counts m + d for a length difference d while the
+    # alignment it walked costs 2m - d, so with m = max_edits - 1 and d = 1 it can go above the limit.
+    return max(max_edits, 2 * max_edits - 3)
+
+
+def _cheapest_grams(costs: List[int], count: int, n: int) -> Tuple[int, ...]:
+    # Start offsets of `count` non-overlapping n-grams with the smallest total cost.
+    length = len(costs)
+    unreachable = (float('inf'), ())
+
+    # best[i] holds the cheapest picks among the n-grams starting at or after i.
+    best = [(0, ())] * (length + n)
+    for _ in range(count):
+        current = [unreachable] * (length + n)
+        for i in range(length - 1, -1, -1):
+            rest_cost, rest_picks = best[i + n]
+            current[i] = min(current[i + 1], (costs[i] + rest_cost, (i, ) + rest_picks))
+        best = current
+
+    return best[0][1]
+
+
+class EditDistanceIndex:
+    """
+    Finds the aliases within a small edit distance of a target without comparing the target against every alias.
+
+    `max_distance` is the largest Levenshtein distance the kernel can accept for `max_edits` (see
+    levenshtein_bound). Take max_distance + 1 non-overlapping pieces of the target: each edit touches at most one of
+    them, so at least one piece appears unchanged in any accepted alias. The pieces are the target's n-grams with
+    the shortest postings in an NGramIndex (shorter grams for short targets), and candidates are the aliases
+    containing one of them whose length is within max_distance of the target. within_distance_batch then decides on
+    all the candidates in one call over the packed aliases. Targets too short to split are compared against every
+    alias of a close enough length.
+    """
+
+    def __init__(self, aliases: Iterable[str], max_edits: int = 2, n: int = 3):
+        self.aliases: List[str] = list(aliases)
+        self.max_edits = max_edits
+        self.max_distance = levenshtein_bound(max_edits)
+        self.packed = PackedAliases(self.aliases)
+
+        self.grams = NGramIndex(self.aliases, n)
+
+        # Number of searches, and aliases handed to the distance kernel by them.
+        self.searches = 0
+        self.compared = 0
+
+        self._lengths: List[int] = [len(alias) for alias in self.aliases]
+        self._by_length: Dict[int, List[int]] = {}
+        for position, alias in enumerate(self.aliases):
+            self._by_length.setdefault(len(alias), []).append(position)
+
+    def candidates(self, target: str) -> List[int]:
+        # Positions of the aliases that may be within max_distance of target, in alias order.
+        low, high = len(target) - self.max_distance, len(target) + self.max_distance
+        count = self.max_distance + 1
+
+        # Longest gram size that still fits max_distance + 1 times in the target.
+        size = min(self.grams.n, len(target) // count)
+        if not size:
+            positions = set()
+            for length in range(max(low, 0), high + 1):
+                positions.update(self._by_length.get(length, ()))
+            return sorted(positions)
+
+        positions = set()
+        postings = [self.grams.posting(target[i:i + size]) for i in range(len(target) - size + 1)]
+        for i in _cheapest_grams([len(posting) for posting in postings], count, size):
+            positions |= postings[i]
+
+        lengths = self._lengths
+        return sorted(position for position in positions if low <= lengths[position] <= high)
+
+    def positions(self, target: str) -> List[int]:
+        # Positions of the aliases within max_edits of target, in alias order.
+        candidates = self.candidates(target)
+
+        self.searches += 1
+        self.compared += len(candidates)
+
+        return within_distance_batch(target, self.packed, self.max_edits, False, candidates)
+
+    def search(self, target: str) -> List[str]:
+        aliases = self.aliases
+        return [aliases[position] for position in self.positions(target)]
+
+    def stats(self) -> Dict[str, int]:
+        # 'scanned' is what comparing against every alias would have cost.
+        return {'searches': self.searches, 'compared': self.compared, 'scanned': self.searches * len(self.aliases)}
+
+
+class OfficeAliasIndex:
+    """
+    Maps the aliases generated for every Office back to office ids.
+
+    `find` is the exact lookup: the first office (in the order given) having the target as an alias.
+    `within_distance` lists the offices with an alias within `max_edits` of the target, through an EditDistanceIndex.
+    """
+
+    def __init__(self, offices: Iterable[Office], max_edits: int = 4):
+        self.alias_dict: Dict[str, int] = {}
+
+        # alias -> every office generating it, in the order given.
+        self._alias_offices: Dict[str, List[int]] = {}
+        for office in offices:
+            for alias in office.aliases:
+                self.alias_dict.setdefault(alias, office.id)
+                self._alias_offices.setdefault(alias, []).append(office.id)
+
+        self.fuzzy = EditDistanceIndex(self._alias_offices, max_edits)
+
+    def find(self, target: str) -> Optional[int]:
+        return self.alias_dict.get(target)
+
+    def within_distance(self, target: str) -> List[int]:
+        # One office id per accepted alias, as when scanning the aliases of every office.
+        office_ids = []
+        for alias in self.fuzzy.search(target):
+            office_ids.extend(self._alias_offices[alias])
+        return office_ids
+
+
+class AliasCatalog:
+    """
+    The aliases of every name source as one table: alias id, source, member id and [start, end) dates per row.
+
+    Peerage and military titles match a target occurring inside the alias, offices and speakers match the alias
+    itself. `lookup` finds the rows of every source for a target in one probe, `members` then keeps the rows of
+    one source valid on a date. Rows with missing dates never match a date, they only record that the source has
+    the alias (an office nobody held, a speaker name outside the speaker's aliases).
+    """
+
+    PEERAGE_TITLES, MILITARY_TITLES, OFFICES, SPEAKERS = range(4)
+
+    # Sources matched by containment, the others by equality.
+    CONTAINED = (PEERAGE_TITLES, MILITARY_TITLES)
+
+    def __init__(self, aliases: Iterable[str], sources: Iterable[int], member_ids: Iterable[float],
+                 starts: numpy.ndarray, ends: numpy.ndarray, n: int = 3):
+        aliases = numpy.asarray(list(aliases), dtype=object)
+        sources = numpy.asarray(list(sources), dtype=numpy.int8)
+        member_ids = numpy.asarray(list(member_ids), dtype=numpy.float64)
+        starts, ends = _nanoseconds(starts).copy(), _nanoseconds(ends).copy()
+
+        missing = numpy.iinfo(numpy.int64).min
+        never = (starts == missing) | (ends == missing) | (starts >= ends)
+        starts[never] = missing
+        ends[never] = missing
+
+        # Alias ids in order of first appearance, with the aliases of the contained sources first so the n-gram
+        # index only covers those.
+        contained = numpy.isin(sources, self.CONTAINED)
+        first = numpy.argsort(~contained, kind='stable')
+        codes, uniques = pd.factorize(aliases[first])
+        alias_ids = numpy.empty(len(aliases), dtype=numpy.int64)
+        alias_ids[first] = codes
+        self.aliases: List[str] = list(uniques)
+        self._alias_ids: Dict[str, int] = {alias: i for i, alias in enumerate(self.aliases)}
+        self.grams = NGramIndex(self.aliases[:len(numpy.unique(codes[:contained.sum()]))], n)
+
+        # Rows grouped by alias id, then by source and in the order given: alias i owns rows _first[i] up to
+        # _first[i + 1].
+        order = numpy.lexsort((sources, alias_ids))
+        self.alias_ids = alias_ids[order].astype(numpy.int32)
+        self.sources = sources[order]
+        self.member_ids = member_ids[order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+        self._first = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(alias_ids, minlength=len(self.aliases)))))
+        self._contained = numpy.isin(self.sources, self.CONTAINED)
+
+        self._empty = numpy.array([], dtype=numpy.int64)
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    @property
+    def nbytes(self) -> int:
+        # Size of the row arrays.
+        return sum(column.nbytes for column in (self.alias_ids, self.sources, self.member_ids, self.starts,
+                                                self.ends, self._first, self._contained))
+
+    def _rows(self, alias_ids: numpy.ndarray) -> numpy.ndarray:
+        first = self._first
+        counts = first[alias_ids + 1] - first[alias_ids]
+        return numpy.repeat(first[alias_ids] - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+
+    def lookup(self, target: str) -> numpy.ndarray:
+        # Rows of the contained sources with an alias containing target, and of the others with target as alias.
+        rows = self._empty
+        containing = self.grams.containing(target)
+        if containing:
+            rows = self._rows(numpy.fromiter(containing, dtype=numpy.int64, count=len(containing)))
+            rows = rows[self._contained[rows]]
+        alias_id = self._alias_ids.get(target)
+        if alias_id is not None:
+            exact = numpy.arange(self._first[alias_id], self._first[alias_id + 1])
+            rows = numpy.concatenate((rows, exact[~self._contained[exact]]))
+        return rows
+
+    def has(self, rows: numpy.ndarray, source: int) -> bool:
+        # Whether source has any of the rows, whatever their dates.
+        return bool((self.sources[rows] == source).any())
+
+    def members(self, rows: numpy.ndarray, source: int, date: datetime,
+                window: Optional[DateWindow] = None) -> numpy.ndarray:
+        # Member ids (NaN when unknown) of the rows of source valid on date, in row order.
+        rows = rows[self.sources[rows] == source]
+        starts, ends = self.starts[rows], self.ends[rows]
+        if window is not None and len(rows):
+            window.add_intervals(starts, ends)
+        date = pd.Timestamp(date).value
+        return self.member_ids[rows[(starts <= date) & (date < ends)]]
+
+
+class BestGuessIndex:
+    """
+    Finds the name closest to a target (by Jaro similarity) among the names valid on a date.
+
+    Every name comes with the [start, end) windows it is valid over. Candidates are blocked on shared n-grams: the
+    names sharing the most n-grams with the target are kept, up to `max_candidates`, leaving out n-grams common to
+    more than `max_posting` names. So a search costs about the same whatever the target. The candidates valid on
+    the date are scored by a JaroScorer, and the best one scoring at least `threshold` is the guess.
+    """
+
+    def __init__(self, names: Iterable[str], starts: numpy.ndarray, ends: numpy.ndarray, n: int = 3,
+                 max_candidates: int = 256, max_posting: int = 2048, threshold: float = 0.8):
+        self.n = n
+        self.max_candidates = max_candidates
+        self.max_posting = max_posting
+        self.threshold = threshold
+
+        # Distinct names in order of first appearance, ties between equal scores go to the earliest.
+        name_positions: Dict[str, int] = {}
+        owners = numpy.array([name_positions.setdefault(name, len(name_positions)) for name in names], dtype=int)
+        self.names: List[str] = list(name_positions)
+
+        # Windows grouped by name: name i owns rows _first[i] up to _first[i + 1].
+        order = numpy.argsort(owners, kind='stable')
+        self._owners = owners[order]
+        self._starts = numpy.asarray(starts, dtype='datetime64[ns]')[order]
+        self._ends = numpy.asarray(ends, dtype='datetime64[ns]')[order]
+        self._first = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(owners, minlength=len(self.names)))))
+
+        # gram -> positions of the names containing it, grouped from (gram code, position) keys in one sort.
+        size = len(self.names)
+        counts = numpy.array([max(len(name) - n + 1, 0) for name in self.names], dtype=numpy.int64)
+        grams = numpy.array([name[i:i + n] for name in self.names for i in range(len(name) - n + 1)], dtype=object)
+        codes, uniques = pd.factorize(grams)
+        keys = numpy.unique(codes.astype(numpy.int64) * size + numpy.repeat(numpy.arange(size), counts))
+        gram_codes, positions = keys // size, keys % size
+        self._postings: Dict[str, numpy.ndarray] = {}
+        if len(keys):
+            bounds = numpy.flatnonzero(numpy.diff(gram_codes)) + 1
+            self._postings.update(zip(uniques[gram_codes[numpy.r_[0, bounds]]], numpy.split(positions, bounds)))
+
+        self.scorer = JaroScorer(PackedAliases(self.names))
+        self._empty = numpy.array([], dtype=numpy.int64)
+
+        # Number of searches, names blocked in by them, names valid on the date and guesses made.
+        self.searches = 0
+        self.blocked = 0
+        self.candidate_count = 0
+        self.guesses = 0
+
+    def candidates(self, target: str) -> numpy.ndarray:
+        # Positions of at most max_candidates names sharing the most n-grams with target, in name order.
+        n = self.n
+        postings = []
+        for gram in {target[i:i + n] for i in range(len(target) - n + 1)}:
+            posting = self._postings.get(gram)
+            if posting is not None and len(posting) <= self.max_posting:
+                postings.append(posting)
+        if not postings:
+            return self._empty
+
+        positions, shared = numpy.unique(numpy.concatenate(postings), return_counts=True)
+        if len(positions) > self.max_candidates:
+            keep = numpy.argsort(-shared, kind='stable')[:self.max_candidates]
+            positions = numpy.sort(positions[keep])
+        return positions
+
+    def search(self, target: str, date: datetime, window: Optional[DateWindow] = None) -> Tuple[Optional[str], float]:
+        # The best guess and its score, or (None, 0.0).
+        self.searches += 1
+        candidates = self.candidates(target)
+        self.blocked += len(candidates)
+        if not len(candidates):
+            return None, 0.0
+
+        # Every window of every candidate, the candidates themselves do not depend on the date.
+        first = self._first
+        counts = first[candidates + 1] - first[candidates]
+        rows = numpy.repeat(first[candidates] - numpy.cumsum(counts) + counts, counts) + numpy.arange(counts.sum())
+        starts, ends = self._starts[rows], self._ends[rows]
+        if window is not None:
+            window.add_intervals(starts, ends)
+        date = numpy.datetime64(date)
+        valid = numpy.unique(self._owners[rows][(date >= starts) & (date < ends)])
+
+        self.candidate_count += len(valid)
+        best = self.scorer.top_k(target, 1, self.threshold, positions=valid)
+        if not best:
+            return None, 0.0
+        self.guesses += 1
+        position, score = best[0]
+        return self.names[position], score
+
+    def stats(self) -> Dict[str, int]:
+        return {'searches': self.searches, 'blocked': self.blocked, 'candidates': self.candidate_count,
+                'scored': self.scorer.scored, 'guesses': self.guesses}
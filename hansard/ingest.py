@@ -0,0 +1,90 @@
+import io
+from typing import Iterator, Tuple
+
+import pandas as pd
+
+from hansard import DATE_FORMAT
+
+# Columns of DATA_FILE read for every row.
+INPUT_COLUMNS = ['sentence_id', 'speechdate', 'speaker', 'debate_id', 'speaker_house']
+
+
+def normalize_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    # speaker_house becomes 1 for the Commons, 2 for the Lords and 0 otherwise. A chunk where it is always missing
+    # reads it as a float column.
+    chunk['speaker_house'] = chunk['speaker_house'].fillna('').str.replace('[^A-Za-z ]', '', regex=True)
+    is_commons = chunk['speaker_house'] == 'HOUSE OF COMMONS'
+    is_lords = chunk['speaker_house'] == 'HOUSE OF LORDS'
+    chunk['speaker_house'] = is_commons + (is_lords * 2)
+    chunk['speechdate'] = pd.to_datetime(chunk['speechdate'], format=DATE_FORMAT)
+    return chunk
+
+
+def byte_ranges(path: str, size: int, block_size: int = 2**20) -> Iterator[Tuple[int, int]]:
+    """
+    Splits the records of a CSV file, after its header line, into [start, end) byte ranges of about `size` bytes.
+
+    A range ends after the first newline past `size` bytes that is outside any quoted field. A newline is inside one
+    when an odd number of quotes comes before it, escaped quotes ("") being pairs. The file is read once, block by
+    block, only counting quotes and finding newlines.
+    """
+    with open(path, 'rb') as f:
+        f.readline()
+        start = offset = f.tell()
+        in_quotes = False
+
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+
+            # Quotes are counted up to pos.
+            pos = 0
+            while True:
+                target = max(start + size - offset, pos)
+                if target >= len(block):
+                    break
+                in_quotes ^= block.count(b'"', pos, target) & 1
+                pos = target
+
+                newline = block.find(b'\n', pos)
+                while newline != -1:
+                    in_quotes ^= block.count(b'"', pos, newline) & 1
+                    pos = newline + 1
+                    if not in_quotes:
+                        break
+                    newline = block.find(b'\n', pos)
+                if newline == -1:
+                    break
+
+                yield start, offset + pos
+                start = offset + pos
+
+            in_quotes ^= block.count(b'"', pos) & 1
+            offset += len(block)
+
+        if offset > start:
+            yield start, offset
+
+
+class ByteRange:
+    """
+    Records of DATA_FILE in [start, end), handed to a worker which reads and normalizes them itself.
+    """
+
+    def __init__(self, path: str, start: int, end: int):
+        self.path = path
+        self.start = start
+        self.end = end
+
+    @property
+    def nbytes(self) -> int:
+        return self.end - self.start
+
+    def load(self) -> pd.DataFrame:
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+            f.seek(self.start)
+            data = f.read(self.end - self.start)
+        chunk = pd.read_csv(io.BytesIO(header + data), sep=',', usecols=INPUT_COLUMNS)
+        return normalize_chunk(chunk)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 from typing import Dict, List, Optional, Tuple, Set
 
@@ -6,12 +7,66 @@ import pandas as pd
 from hansard import DATE_FORMAT, DATE_FORMAT2, MP_ALIAS_PATTERN, cleanse_string
 from hansard.speaker import SpeakerReplacement, OfficeHolding, Office, OfficeTerm
 from hansard.exceptions import *
+from hansard.index import AliasCatalog, BestGuessIndex, DateIntervalIndex, EditDistanceIndex, OfficeAliasIndex, \
+    DatedAliasIndex
 from datetime import datetime
 import logging
 import calendar
 import re
 
 
+# Files and directories read by DataStruct.load(), under the source names resolutions record them by.
+DATA_SOURCES: Dict[str, str] = {
+    'speakers': 'data/mps/speakers-names/speakers.csv',
+    'terms': 'data/mps/speakers-names/speakers_terms.csv',
+    'peerage_titles': 'data/mps/peerage-titles',
+    'military_titles': 'data/mps/military-titles',
+    'offices': 'data/titles/office_titles.csv',
+    'holdings': 'data/mps/office-holdings/office-holdings.csv',
+    'non_mps': 'data/non-mps',
+    'inferences': 'data/inferences.csv',
+}
+
+
+def data_source_versions() -> Dict[str, str]:
+    # Content hash of every data source. A directory hashes the relative path and contents of every file under it.
+    versions = {}
+    for source, path in DATA_SOURCES.items():
+        if os.path.isdir(path):
+            filepaths = sorted(os.path.join(dirpath, fn) for dirpath, _, filenames in os.walk(path) for fn in filenames)
+        else:
+            filepaths = [path]
+
+        digest = hashlib.sha256()
+        for filepath in filepaths:
+            digest.update(os.path.relpath(filepath, path).encode())
+            with open(filepath, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        versions[source] = digest.hexdigest()
+    return versions
+
+
+def single_speaker_segments(speakers: List[SpeakerReplacement]) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
+    # [start, end) windows where exactly one of the speakers is within their (inclusive) start and end dates.
+    events = []
+    for speaker in speakers:
+        if pd.isna(speaker.start_date) or pd.isna(speaker.end_date):
+            continue
+        events.append((pd.Timestamp(speaker.start_date), 1))
+        events.append((pd.Timestamp(speaker.end_date) + pd.Timedelta(1), -1))
+    events.sort()
+
+    segments = []
+    active = 0
+    previous = None
+    for point, change in events:
+        if active == 1 and previous < point:
+            segments.append((previous, point))
+        active += change
+        previous = point
+    return segments
+
+
 def fix_estimated_date(date_str, start=True, splitchr='/'):
     if type(date_str) == int:
         date = [str(date_str, )]
@@ -55,10 +110,19 @@ class DataStruct:
         self.speaker_dict: Dict[int, SpeakerReplacement] = {}
         self.alias_dict: Dict[str, List[SpeakerReplacement]] = {}
 
+        # Edit distance aliases -> member ids, searched by the last resort fuzzy match.
+        self.edit_distance_dict: Dict[str, List[int]] = {}
+        self.edit_distance_index: Optional[EditDistanceIndex] = None
+
         self.corrections: Dict[str, str] = {}
 
         self.office_dict: Dict[int, Office] = {}
+        self.office_index: Optional[OfficeAliasIndex] = None
         self.holdings: List[OfficeHolding] = []
+        self.holdings_df: Optional[pd.DataFrame] = None
+
+        # office id -> holdings, searchable by date.
+        self.holdings_index: Optional[DateIntervalIndex] = None
 
         self.term_df: Optional[pd.DataFrame] = None
         self.honorary_titles_df: Optional[pd.DataFrame] = None
@@ -66,6 +130,15 @@ class DataStruct:
         self.lord_titles_df: Optional[pd.DataFrame] = None
         self.aliases_df: Optional[pd.DataFrame] = None
 
+        # Peerage titles, military titles, office holdings and speaker aliases, for the exact lookups.
+        self.alias_catalog: Optional[AliasCatalog] = None
+
+        # lord_titles_df rows with their search windows, for the edit distance search.
+        self.lord_titles_aliases: Optional[DatedAliasIndex] = None
+
+        # Closest valid name for the rows nothing resolves, only loaded when asked for.
+        self.best_guess_index: Optional[BestGuessIndex] = None
+
         # Debate id -> member id
         self.inferences: Dict[int, int] = {}
 
@@ -94,6 +167,11 @@ class DataStruct:
         self._load_term_metadata()
         self._load_corrections()
 
+        self._load_edit_distance_aliases()
+
+        self._load_alias_catalog()
+        self.lord_titles_aliases = DatedAliasIndex(self.lord_titles_df, 'alias')
+
         self.ignored_set = set()
         for dirpath, _, filenames in os.walk('data/non-mps'):
             for fn in filenames:
@@ -110,6 +188,65 @@ class DataStruct:
         infer_df = pd.read_csv('data/inferences.csv')
         self.inferences = dict(infer_df.itertuples(index=False))
 
+    def _load_alias_catalog(self):
+        frames = [pd.DataFrame({'alias': df['alias'], 'source': source, 'member_id': df['corresponding_id'],
+                                'start': df['start_search'], 'end': df['end_search']})
+                  for source, df in ((AliasCatalog.PEERAGE_TITLES, self.lord_titles_df),
+                                     (AliasCatalog.MILITARY_TITLES, self.aliases_df))]
+
+        # Every holding of the office an alias finds, no dates for an office nobody held.
+        offices = pd.DataFrame(list(self.office_index.alias_dict.items()), columns=['alias', 'office_id'])
+        holdings = offices.merge(self.holdings_df, on='office_id', how='left')
+        frames.append(pd.DataFrame({'alias': holdings['alias'], 'source': AliasCatalog.OFFICES,
+                                    'member_id': holdings['corresponding_id'], 'start': holdings['start_search'],
+                                    'end': holdings['end_search']}))
+
+        # Speakers are valid up to their end date included. A speaker only matches the names among its aliases.
+        dates = {speaker.member_id: (pd.Timestamp(speaker.start_date).value, pd.Timestamp(speaker.end_date).value + 1)
+                 for speaker in self.speakers}
+        missing = (numpy.iinfo(numpy.int64).min, ) * 2
+        speakers = pd.DataFrame([(alias, speaker.member_id) + (dates[speaker.member_id] if alias in speaker.aliases
+                                                               else missing)
+                                 for alias, alias_speakers in self.alias_dict.items() for speaker in alias_speakers],
+                                columns=['alias', 'member_id', 'start', 'end'])
+        frames.append(speakers.assign(source=AliasCatalog.SPEAKERS,
+                                      start=speakers['start'].to_numpy().view('datetime64[ns]'),
+                                      end=speakers['end'].to_numpy().view('datetime64[ns]')))
+
+        catalog = pd.concat(frames, ignore_index=True)
+        self.alias_catalog = AliasCatalog(catalog['alias'], catalog['source'], catalog['member_id'],
+                                          catalog['start'].to_numpy(dtype='datetime64[ns]'),
+                                          catalog['end'].to_numpy(dtype='datetime64[ns]'))
+        logging.info(f'{len(self.alias_catalog)} aliases catalogued in {self.alias_catalog.nbytes} bytes.')
+
+    def load_best_guess_index(self, max_candidates: int = 256):
+        # Honorary titles (when loaded), lord titles, name aliases and then the aliases of a single speaker on the date.
+        frames = [df[[column, 'start_search', 'end_search']].set_axis(['name', 'start', 'end'], axis=1)
+                  for df, column in ((self.honorary_titles_df, 'honorary_title'), (self.lord_titles_df, 'alias'),
+                                     (self.aliases_df, 'alias'))
+                  if df is not None]
+        # Aliases of a single speaker are valid over the speaker's dates, end date included.
+        dates = {speaker.member_id: (pd.Timestamp(speaker.start_date), pd.Timestamp(speaker.end_date) + pd.Timedelta(1))
+                 for speaker in self.speakers}
+        # Speaker aliases come out of sets, sorted so ties between equal scores go the same way on every run.
+        speaker_aliases = sorted(self.alias_dict.items(), key=lambda item: item[0])
+        single = [(order, alias, speakers[0].member_id)
+                  for order, (alias, speakers) in enumerate(speaker_aliases) if len(speakers) == 1]
+        single = pd.DataFrame([(order, alias) + dates[member_id] for order, alias, member_id in single],
+                              columns=['order', 'name', 'start', 'end'])
+        shared = pd.DataFrame([(order, alias, start, end)
+                               for order, (alias, speakers) in enumerate(speaker_aliases) if len(speakers) > 1
+                               for start, end in single_speaker_segments(speakers)],
+                              columns=['order', 'name', 'start', 'end'])
+        frames.append(pd.concat([single, shared]).sort_values('order', kind='stable').drop(columns='order'))
+        names = pd.concat(frames, ignore_index=True)
+        names = names[~names['name'].isna()]
+
+        self.best_guess_index = BestGuessIndex(names['name'], names['start'].to_numpy(dtype='datetime64[ns]'),
+                                               names['end'].to_numpy(dtype='datetime64[ns]'),
+                                               max_candidates=max_candidates)
+        logging.info(f'{len(self.best_guess_index.names)} names loaded for best guesses.')
+
     def _load_lord_titles(self):
         dfs = []
         for csv in os.listdir('data/mps/peerage-titles'):
@@ -223,6 +360,20 @@ class DataStruct:
         logging.info(f'{missing_sn_name} speakers with malformed surnames', )
         logging.info(f'{len(speakers)} speakers sucessfully loaded out of {len(mps)} rows.')
 
+    def _load_edit_distance_aliases(self):
+        edit_distance_dict = self.edit_distance_dict
+
+        # extended_edit_distance_set = set()
+
+        for speaker in self.speakers:
+            # if len(speaker.last_name) > 8:
+            #     for alias in speaker.generate_edit_distance_aliases():
+            #         extended_edit_distance_set.add(alias)
+            for alias in speaker.generate_edit_distance_aliases():
+                edit_distance_dict.setdefault(alias, []).append(speaker.member_id)
+
+        self.edit_distance_index = EditDistanceIndex(edit_distance_dict, max_edits=2)
+
     @staticmethod
     def load_correction_csv_as_dict(filepath: str, encoding=None) -> dict:
         misspellings = pd.read_csv(filepath, encoding=encoding)
@@ -276,6 +427,7 @@ class DataStruct:
         for index, row in offices_df.iterrows():
             office = Office(row['office_id'], row['name'])
             self.office_dict[office.id] = office
+        self.office_index = OfficeAliasIndex(office_dict.values())
 
         logging.info('Loading office holdings...')
         holdings_df = pd.read_csv('data/mps/office-holdings/office-holdings.csv', sep=',')
@@ -285,6 +437,7 @@ class DataStruct:
         holdings_df = holdings_df[holdings_df['corresponding_id'].isin(speaker_dict.keys())]
         holdings_df = holdings_df[holdings_df['office_id'].isin(office_dict.keys())]
         self.holdings_df = holdings_df
+        self.holdings_index = DateIntervalIndex(holdings_df, 'office_id')
 
         logging.debug(f'{len(holdings_df)} office holdings successfully loaded out of {old_length} rows.')
 
@@ -1,5 +1,10 @@
 import unittest
 import datetime
+import random
+import re
+
+import numpy
+import pandas as pd
 
 from .speaker import SpeakerReplacement, Office
 
@@ -219,9 +224,849 @@ class TestJaroDistance(unittest.TestCase):
         distances = [jaro_distance(c, s) for c in candidates]
         self.assertTrue(max(distances) == jaro_distance('mr jeffreys', s))
 
+    def test_winkler(self):
+        from util.jaro_distance import jaro_winkler_distance
+
+        self.assertAlmostEqual(jaro_distance('MARTHA', 'MARHTA'), 0.944, delta=0.001)
+        self.assertAlmostEqual(jaro_winkler_distance('MARTHA', 'MARHTA'), 0.961, delta=0.001)
+        self.assertTrue(jaro_winkler_distance('', 'abc') == 0.0)
+
+    def test_top_k(self):
+        from util.edit_distance import PackedAliases
+        from util.jaro_distance import JaroScorer, jaro_winkler_distance
+
+        aliases = ['mr jeffreys', 'mr juffreys', 'jeff', '', 'mr joffreys', 'mr jeffreys', 'sir robert peel', 'mr o’connell']
+        scorer = JaroScorer(PackedAliases(aliases))
+
+        for target in ('mr jefreys', 'mr o’conell', 'peel', ''):
+            for distance_func, winkler in ((jaro_distance, False), (jaro_winkler_distance, True)):
+                scores = [(-distance_func(target, alias), position) for position, alias in enumerate(aliases)]
+                for k, threshold in ((1, 0.0), (3, 0.7), (10, 0.0)):
+                    expected = [(position, -score) for score, position in sorted(scores) if -score >= threshold][:k]
+                    self.assertEqual(scorer.top_k(target, k, threshold, winkler), expected, (target, k, threshold))
+
+        expected = [(1, jaro_distance('mr jefreys', aliases[1])), (2, jaro_distance('mr jefreys', aliases[2]))]
+        self.assertEqual(scorer.top_k('mr jefreys', 2, positions=[6, 1, 2]), expected)
+
+
+from hansard.corrections import LiteralCorrector, RegexCorrector
+
+
+class TestLiteralCorrector(unittest.TestCase):
+    @staticmethod
+    def replace_all(string_val, corrections):
+        for k, v in corrections:
+            string_val = string_val.replace(k, v)
+        return string_val
+
+    def test_ordered(self):
+        corrections = [('By Mr. Robinson.', 'Mr. Robinson'), ('Mr. Robinson', 'F. Robinson'), ('F. Rob', 'X')]
+        corrector = LiteralCorrector(corrections)
+
+        for s in ('By Mr. Robinson.', 'Mr. Robinson', 'By Mr. Robinson. By Mr. Robinson.', 'Mr. GLADSTONE', ''):
+            self.assertEqual(corrector.apply(s), self.replace_all(s, corrections))
+
+    def test_created_occurrence(self):
+        # 'ab' only exists once the first rule has deleted the 'x'.
+        corrections = [('x', ''), ('ab', 'c'), ('cc', 'd')]
+        corrector = LiteralCorrector(corrections)
+
+        for s in ('axb', 'axbab', 'ab', 'xx', 'aaxbb'):
+            self.assertEqual(corrector.apply(s), self.replace_all(s, corrections))
+
+    def test_overlapping(self):
+        corrections = [('aba', 'c'), ('ba', 'd'), ('a', 'b')]
+        corrector = LiteralCorrector(corrections)
+
+        for s in ('ababa', 'baba', 'aaa', 'cab'):
+            self.assertEqual(corrector.apply(s), self.replace_all(s, corrections))
+
+    def test_pre_corrections(self):
+        from hansard.worker import PRE_CORRECTIONS, PRE_CORRECTOR
+
+        for k, v in PRE_CORRECTIONS:
+            for s in (k, f'Mr. {k} ', k + v, v + k):
+                self.assertEqual(PRE_CORRECTOR.apply(s), self.replace_all(s, PRE_CORRECTIONS))
+
+
+class TestRegexCorrector(unittest.TestCase):
+    @staticmethod
+    def sub_all(string_val, corrections):
+        for k, v in corrections:
+            string_val = re.sub(k, v, string_val)
+        return string_val
+
+    def test_anchored(self):
+        corrections = [(re.compile(k), v) for k, v in (
+            ('^tiie +', 'the '),
+            ('^the +', ''),
+            ('^mr attorney-?general', 'attorney-general'),
+            ('^a|b', 'x'),
+            ('^[a-c]+ ', ''),
+            (' said$', ''),
+            ('^.+ sir ', 'sir '),
+        )]
+        corrector = RegexCorrector(corrections)
+
+        for s in ('tiie the speaker', 'mr attorneygeneral said', 'mr attorney-general', 'abc cab',
+                  'the lord sir robert peel said', 'bob', 'the', ''):
+            self.assertEqual(corrector.apply(s), self.sub_all(s, corrections))
+
+    def test_post_corrections(self):
+        from hansard.worker import REGEX_POST_CORRECTIONS, POST_CORRECTOR
+
+        for k, v in REGEX_POST_CORRECTIONS:
+            words = k.pattern.strip('^$').replace(' +', ' ')
+            for s in (words, f'the {words} said', f'{v} {words}', f'mr {words}'):
+                self.assertEqual(POST_CORRECTOR.apply(s), self.sub_all(s, REGEX_POST_CORRECTIONS))
+
+
+from hansard.cache import BloomFilter, IntervalCache, LRUMemo, NegativeCache, PersistentResolutionCache, \
+    SharedIntervalCache, SLRUCache
+
+
+class TestLRUMemo(unittest.TestCase):
+    def test_eviction(self):
+        calls = []
+        memo = LRUMemo(lambda x: calls.append(x) or x.upper(), max_size=2)
+
+        self.assertEqual(memo('a'), 'A')
+        self.assertEqual(memo('b'), 'B')
+        self.assertEqual(memo('a'), 'A')
+        self.assertEqual(memo('c'), 'C')  # evicts 'b', 'a' was used more recently
+        self.assertEqual(memo('a'), 'A')
+        self.assertEqual(memo('b'), 'B')
+
+        self.assertEqual(calls, ['a', 'b', 'c', 'b'])
+        self.assertEqual(memo.stats(), {'hits': 2, 'misses': 4, 'evictions': 2, 'size': 2})
+        self.assertAlmostEqual(memo.hit_rate, 2 / 6)
+
+
+class TestIntervalCache(unittest.TestCase):
+    def test_windows(self):
+        cache = IntervalCache(2**20)
+        cache.put('earl grey', 10, 20, 'a')
+        cache.put('earl grey', 30, 31, 'b')
+        cache.put('earl grey', 0, 10, 'c')
+
+        expected = {-1: None, 0: 'c', 9: 'c', 10: 'a', 19: 'a', 20: None, 29: None, 30: 'b', 31: None}
+        for date, value in expected.items():
+            self.assertEqual(cache.get('earl grey', date), value, date)
+        self.assertIsNone(cache.get('lord grey', 10))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['size']), (5, 5, 0, 3))
+
+    def test_eviction(self):
+        cache = IntervalCache(4 * (IntervalCache.KEY_OVERHEAD + IntervalCache.WINDOW_OVERHEAD + 200))
+        for i in range(20):
+            cache.put(f'speaker {i}', 0, 10, str(i))
+            cache.get('speaker 0', 5)
+
+        # The key looked up after every put stays, the others are evicted oldest first.
+        self.assertEqual(cache.get('speaker 0', 5), '0')
+        self.assertEqual(cache.get('speaker 19', 5), '19')
+        self.assertIsNone(cache.get('speaker 1', 5))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 20 - stats['size'])
+        self.assertLessEqual(stats['bytes'], cache._windows.max_bytes)
+
+
+class TestSLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = SLRUCache(max_bytes=40, protected_share=0.5)
+        cache.put('a', 1, 10)
+        cache.put('b', 2, 10)
+        self.assertEqual(cache.get('a'), 1)  # protected from now on
+        cache.put('c', 3, 10)
+        cache.put('d', 4, 10)
+        cache.put('e', 5, 10)  # over budget, evicts 'b', the oldest key on probation
+
+        self.assertNotIn('b', cache)
+        self.assertEqual([cache.get(key) for key in 'acde'], [1, 3, 4, 5])
+        # Protected keys beyond half of the budget fell back to probation and were evicted in turn.
+        cache.put('f', 6, 10)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.stats(), {'hits': 5, 'misses': 0, 'evictions': 2, 'bytes': 40, 'size': 4})
+
+        # Probation is emptied before any protected key is evicted, even of the key just put.
+        cache.put('f', 7, 30)
+        self.assertNotIn('f', cache)
+        self.assertEqual([cache.get(key) for key in 'de'], [4, 5])
+        self.assertEqual(cache.bytes, 20)
+
+
+class TestSharedIntervalCache(unittest.TestCase):
+    def test_windows(self):
+        import os
+        import pickle
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = SharedIntervalCache(os.path.join(directory, 'cache.sqlite'), max_size=3, evict_batch=1)
+            cache.put('earl grey', 10, 20, ('1', 0, 1))
+            cache.put('earl grey', 20, 30, (None, 0, 0))
+            cache.put('earl grey', 20, 30, (None, 0, 0))
+
+            # A copy handed to another process opens its own connection to the same file.
+            other = pickle.loads(pickle.dumps(cache))
+            self.assertEqual(other.get('earl grey', 15), (10, 20, ('1', 0, 1)))
+            self.assertEqual(other.get('earl grey', 29), (20, 30, (None, 0, 0)))
+            self.assertIsNone(other.get('earl grey', 30))
+            self.assertIsNone(other.get('lord grey', 15))
+
+            other.put('lord grey', 0, 10, ('2', 0, 0))
+            other.put('lord grey', 10, 20, ('3', 0, 0))  # over max_size, keeps the newest max_size - 1
+            self.assertIsNone(cache.get('earl grey', 15))
+            self.assertEqual(cache.get('lord grey', 5), (0, 10, ('2', 0, 0)))
+
+            self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'inserts': 2, 'evictions': 0})
+            self.assertEqual(other.stats(), {'hits': 2, 'misses': 2, 'inserts': 2, 'evictions': 2})
+            cache.close()
+            other.close()
+
+
+def add_to_filter(bloom, values):
+    # Target of the spawned process in TestNegativeCache.
+    for value in values:
+        bloom.add(value)
+
+
+class TestNegativeCache(unittest.TestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(2**12)
+        try:
+            for i in range(100):
+                bloom.add(f'speaker {i}')
+            self.assertTrue(all(f'speaker {i}' in bloom for i in range(100)))
+            self.assertLess(sum(f'member {i}' in bloom for i in range(1000)), 50)
+        finally:
+            bloom.close()
+            bloom.unlink()
+
+    def test_bloom_filter_spawned(self):
+        import multiprocessing
+
+        bloom = BloomFilter(2**12)
+        try:
+            # The spawned process gets a pickled copy, attached to the same bits.
+            process = multiprocessing.get_context('spawn').Process(
+                target=add_to_filter, args=(bloom, [f'speaker {i}' for i in range(100)]))
+            process.start()
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+            self.assertTrue(all(f'speaker {i}' in bloom for i in range(100)))
+        finally:
+            bloom.close()
+            bloom.unlink()
+
+    def test_confirmation(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            # A filter this small answers yes to nearly everything, the file decides.
+            cache = NegativeCache(os.path.join(directory, 'negatives.sqlite'), num_bits=8)
+            try:
+                for i in range(10):
+                    cache.add(f'garbage {i}')
+                self.assertTrue(all(f'garbage {i}' in cache for i in range(10)))
+                self.assertFalse(any(f'speaker {i}' in cache for i in range(10)))
+                self.assertEqual(cache.stats(), {'hits': 10, 'misses': 10, 'inserts': 10, 'false_positives': 10})
+            finally:
+                cache.close()
+                cache.filter.close()
+                cache.filter.unlink()
+
+
+class TestPersistentResolutionCache(unittest.TestCase):
+    def test_invalidate(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            versions = {'rules': '1', 'speakers': '1', 'inferences': '1'}
+
+            cache = PersistentResolutionCache(path)
+            self.assertEqual(cache.invalidate(versions), ['inferences', 'rules', 'speakers'])
+            cache.put('earl grey', 10, 20, ('1', 0, 1), {'rules', 'speakers'})
+            cache.put_context('earl grey', 25, '2|100', ('2', 0, 0), {'rules', 'speakers', 'inferences'})
+            cache.close()
+
+            cache = PersistentResolutionCache(path)
+            self.assertEqual(cache.invalidate(versions), [])
+            self.assertEqual(cache.get('earl grey', 15), (10, 20, ('1', 0, 1)))
+            self.assertEqual(cache.get_context('earl grey', 25, '2|100'), ('2', 0, 0))
+            self.assertIsNone(cache.get_context('earl grey', 25, '1|100'))
+
+            self.assertEqual(cache.invalidate(dict(versions, inferences='2')), ['inferences'])
+            self.assertEqual(cache.get('earl grey', 15), (10, 20, ('1', 0, 1)))
+            self.assertIsNone(cache.get_context('earl grey', 25, '2|100'))
+
+            self.assertEqual(cache.invalidate(dict(versions, inferences='2', speakers='2')), ['speakers'])
+            self.assertIsNone(cache.get('earl grey', 15))
+            cache.close()
+
+    def test_rules_version(self):
+        import tempfile
+        import types
+        from unittest import mock
+
+        from hansard import worker
+
+        with tempfile.TemporaryDirectory() as directory:
+            module = types.SimpleNamespace(__file__=directory + '/rules.py')
+            with open(module.__file__, 'w') as f:
+                f.write('RULES = 1\n')
+            with mock.patch.object(worker, 'RULE_MODULES', (module,)):
+                version = worker.rules_version()
+                self.assertEqual(worker.rules_version(), version)
+                with open(module.__file__, 'w') as f:
+                    f.write('RULES = 2\n')
+                self.assertNotEqual(worker.rules_version(), version)
+
+
+from multiprocessing import shared_memory
+
+from hansard.transport import AdmissionQueue, ReorderWindow, SharedFrame, frame_nbytes
+
+
+class TestAdmissionQueue(unittest.TestCase):
+    def test_bounds(self):
+        import threading
+
+        queue = AdmissionQueue(2, 100)
+        queue.put('a', 10)
+        queue.put('b', 10)
+
+        # A third chunk waits for a worker to take one.
+        taker = threading.Timer(0.2, queue.get)
+        taker.start()
+        queue.put('c', 10)
+        taker.join()
+        self.assertEqual(queue.stalls, 1)
+        self.assertGreaterEqual(queue.stall_seconds, 0.1)
+
+        # So does one going over the bytes, unless nothing else is waiting.
+        self.assertEqual([queue.get(), queue.get()], ['b', 'c'])
+        queue.put('d', 1000)
+        self.assertEqual(queue.stalls, 1)
+        taker = threading.Timer(0.2, queue.get)
+        taker.start()
+        queue.put('e', 10)
+        taker.join()
+        self.assertEqual(queue.get(), 'e')
+
+        self.assertEqual(queue.stats(), {'puts': 5, 'stalls': 2, 'stall_seconds': queue.stall_seconds,
+                                         'depth_total': 7, 'depth_max': 2, 'bytes_max': 1000})
+
+    def test_frame_nbytes(self):
+        frame = pd.DataFrame({'speaker': [f'mr speaker {i}' * (i % 5) for i in range(5000)], 'date': numpy.arange(5000)})
+        exact = frame.memory_usage(index=True, deep=True).sum()
+        self.assertAlmostEqual(frame_nbytes(frame) / exact, 1, delta=0.05)
+
+
+def relay_chunks(inq, outq, fail_on):
+    # Worker of TestReorderWindow, dying on the chunk numbered fail_on.
+    import os
+
+    while True:
+        entry = inq.get()
+        if entry is None:
+            return
+        sequence, _ = entry
+        if sequence == fail_on:
+            os._exit(1)
+        outq.put(sequence)
+
+
+class TestReorderWindow(unittest.TestCase):
+    def test_admit(self):
+        import threading
+
+        window = ReorderWindow(3)
+        for sequence in range(3):
+            window.admit(sequence)
+        self.assertEqual(window.stalls, 0)
+
+        # Chunk 3 waits for chunk 0 to be written, chunk 4 can go once 0 and 1 are.
+        exporter = threading.Timer(0.2, window.advance, (2, ))
+        exporter.start()
+        window.admit(3)
+        window.admit(4)
+        exporter.join()
+        self.assertEqual(window.stalls, 1)
+        self.assertGreaterEqual(window.stall_seconds, 0.1)
+
+    def test_worker_died(self):
+        import multiprocessing
+        import threading
+
+        window = ReorderWindow(2)
+        inq, outq = AdmissionQueue(2, 2**20), multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=relay_chunks, args=(inq, outq, 1)) for _ in range(2)]
+        for process in processes:
+            process.start()
+
+        # Writes chunks in order like the exporter of run.py, and whatever is left once the workers are done.
+        written = []
+
+        def export():
+            pending, next_sequence = set(), 0
+            for sequence in iter(outq.get, None):
+                pending.add(sequence)
+                while next_sequence in pending:
+                    pending.remove(next_sequence)
+                    written.append(next_sequence)
+                    next_sequence += 1
+                window.advance(next_sequence)
+            written.extend(sorted(pending))
+
+        exporter = threading.Thread(target=export)
+        exporter.start()
+
+        def any_died():
+            return any(process.exitcode is not None for process in processes)
+
+        # Chunk 1 never comes back, without a release chunk 3 would wait forever.
+        for sequence in range(12):
+            window.admit(sequence, release_if=any_died, interval=0.05)
+            inq.put((sequence, None))
+        for _ in processes:
+            inq.put(None)
+        for process in processes:
+            process.join()
+        outq.put(None)
+        exporter.join()
+
+        self.assertTrue(window.released)
+        self.assertEqual(sorted(process.exitcode for process in processes), [0, 1])
+        self.assertEqual(written, [0] + list(range(2, 12)))
+
+    def test_all_workers_died(self):
+        import multiprocessing
+
+        inq = AdmissionQueue(2, 2**20)
+        process = multiprocessing.Process(target=relay_chunks, args=(inq, multiprocessing.Queue(), 0))
+        process.start()
+        for sequence in range(6):
+            inq.put((sequence, None), release_if=lambda: process.exitcode is not None, interval=0.05)
+        process.join()
+        self.assertEqual(process.exitcode, 1)
+
+
+class TestSharedFrame(unittest.TestCase):
+    def test_round_trip(self):
+        frame = pd.DataFrame({
+            'sentence_id': ['S1', 'S2', 'S3'],
+            'speechdate': pd.to_datetime(['1830-01-01', '1845-06-01', '1900-12-31']),
+            'speaker': ['MR GLADSTONE', numpy.nan, 'Mr M\u00fcller'],
+            'suggested_speaker': [None, '123', None],
+            'ambiguous': [0, 1, 0],
+            'best_guess_score': [0.9, numpy.nan, 1.0],
+        }, index=[10, 11, 12])
+        for expected in (frame, frame.iloc[0:0], frame[['speaker']]):
+            shared = SharedFrame(expected)
+            loaded = shared.load()
+            pd.testing.assert_frame_equal(loaded, expected)
+
+            # Read once, the segment is gone.
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(name=shared.name)
+
+        # Missing values keep their type, and the columns are copies that can be written to.
+        loaded = SharedFrame(frame).load()
+        self.assertIsNone(loaded.loc[10, 'suggested_speaker'])
+        self.assertTrue(numpy.isnan(loaded.loc[11, 'speaker']))
+        loaded.loc[10, 'ambiguous'] = 1
+        self.assertEqual(list(loaded['ambiguous']), [1, 1, 0])
+
+
+from hansard.ingest import INPUT_COLUMNS, ByteRange, byte_ranges, normalize_chunk
+
+
+class TestByteRanges(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        speakers = ['MR GLADSTONE', '"Mr W Charles J Cavendish-Bentinck\nline"', '"MR ""O\'BRIEN"", JUN."', '',
+                    '"THE\n\nSPEAKER"', 'Mr M\u00fcller']
+        houses = ['HOUSE OF COMMONS', '"HOUSE OF, LORDS"', '']
+        lines = ['sentence_id,speechdate,speaker,debate_id,speaker_house,text']
+        for i in range(300):
+            lines.append(f'S{i},18{rng.randint(10, 99)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)},'
+                         f'{rng.choice(speakers)},{rng.randint(1, 9999)},{rng.choice(houses)},"a,\nb"')
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name + '/input.csv'
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_ranges(self):
+        expected = normalize_chunk(pd.read_csv(self.path, usecols=INPUT_COLUMNS))
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        for size, block_size in ((1, 2**20), (100, 7), (1000, 64), (10**6, 2**20)):
+            ranges = list(byte_ranges(self.path, size, block_size))
+            self.assertEqual(ranges[0][0], data.index(b'\n') + 1)
+            self.assertEqual(ranges[-1][1], len(data))
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                # Every range ends a record.
+                self.assertEqual(data[end - 1:end], b'\n')
+                self.assertEqual(data[:end].count(b'"') % 2, 0)
+
+            chunks = [ByteRange(self.path, start, end).load() for start, end in ranges]
+            pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), expected)
+
+
+from hansard.checkpoint import Checkpoint, file_digest, runs
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.output = self.directory.name + '/output.csv'
+        self.layout = {'input': 'abc', 'chunks': '500 rows', 'best_guess': False}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_runs(self):
+        self.assertEqual(runs([]), [])
+        self.assertEqual(runs([5, 0, 1, 2, 7, 6, 9]), [(0, 3), (5, 8), (9, 10)])
+
+    def test_resume(self):
+        self.assertFalse(Checkpoint(self.output, self.layout).resume())
+
+        checkpoint = Checkpoint(self.output, self.layout)
+        with open(self.output, 'w') as f:
+            f.write('a\n1\n2\n3\n')
+        for sequence, size in ((0, 4), (1, 6), (3, 8)):
+            checkpoint.record(sequence, size)
+        checkpoint.save()
+
+        resumed = Checkpoint(self.output, dict(self.layout))
+        self.assertTrue(resumed.resume())
+        self.assertEqual(resumed.written, {0, 1, 3})
+        self.assertEqual(resumed.size, 8)
+
+        with self.assertRaisesRegex(ValueError, 'chunks'):
+            Checkpoint(self.output, {**self.layout, 'chunks': '1000 rows'}).resume()
+        with self.assertRaisesRegex(ValueError, 'rules'):
+            Checkpoint(self.output, {**self.layout, 'rules': '1'}).resume()
+
+        with open(self.output, 'r+') as f:
+            f.truncate(7)
+        with self.assertRaisesRegex(ValueError, 'shorter'):
+            Checkpoint(self.output, self.layout).resume()
+
+    def test_file_digest(self):
+        with open(self.output, 'wb') as f:
+            f.write(bytes(range(256)) * 20)
+        digest = file_digest(self.output, block_size=1000)
+        self.assertEqual(file_digest(self.output), digest)
+
+        # An edit in the middle that keeps the length.
+        with open(self.output, 'r+b') as f:
+            f.seek(2560)
+            f.write(b'x')
+        self.assertNotEqual(file_digest(self.output, block_size=1000), digest)
+
+
+from hansard.index import AliasCatalog, BestGuessIndex, DateIntervalIndex, DateWindow, DatedAliasIndex, \
+    EditDistanceIndex, OfficeAliasIndex
+
+
+class TestDateIntervalIndex(unittest.TestCase):
+    def test_query(self):
+        df = pd.DataFrame({
+            'corresponding_id': [1, 2, 3, 4, 5],
+            'office_id': [7, 7, 8, 7, 8],
+            'start_search': pd.to_datetime(['1830-01-01', '1835-06-01', '1830-01-01', '1840-01-01', '1850-01-01']),
+            'end_search': pd.to_datetime(['1835-06-01', '1841-01-01', '1860-01-01', '1850-01-01', '1850-01-01']),
+        })
+        index = DateIntervalIndex(df, 'office_id')
+
+        for office_ids in ([7], [8], [7, 8], [9], []):
+            for date in ('1820-01-01', '1830-01-01', '1835-05-31', '1835-06-01', '1840-06-01', '1850-01-01'):
+                date = pd.Timestamp(date)
+                expected = df[(date >= df['start_search']) & (date < df['end_search']) & df['office_id'].isin(office_ids)]
+                self.assertTrue(index.query(office_ids, date).equals(expected), (office_ids, date))
+
+    def test_window(self):
+        df = pd.DataFrame({
+            'corresponding_id': [1, 2, 3],
+            'office_id': [7, 7, 8],
+            'start_search': pd.to_datetime(['1830-01-01', '1835-06-01', '1833-01-01']),
+            'end_search': pd.to_datetime(['1835-06-01', '1841-01-01', '1860-01-01']),
+        })
+        index = DateIntervalIndex(df, 'office_id')
+
+        for date, start, end in (('1831-01-01', '1830-01-01', '1835-06-01'), ('1820-01-01', None, '1830-01-01'),
+                                 ('1845-01-01', '1841-01-01', None)):
+            window = DateWindow(pd.Timestamp(date))
+            index.query([7], pd.Timestamp(date), window)
+            self.assertEqual(window.start, pd.Timestamp(start).value if start else numpy.iinfo(numpy.int64).min)
+            self.assertEqual(window.end, pd.Timestamp(end).value if end else numpy.iinfo(numpy.int64).max)
+
+        window = DateWindow(pd.Timestamp('1834-01-01'))
+        index.query([7, 8], pd.Timestamp('1834-01-01'), window)
+        self.assertIn(pd.Timestamp('1833-01-01'), window)
+        self.assertIn(pd.Timestamp('1835-05-31'), window)
+        self.assertNotIn(pd.Timestamp('1832-12-31'), window)
+        self.assertNotIn(pd.Timestamp('1835-06-01'), window)
+
+
+class TestAliasCatalog(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame({
+            'alias': ['earl grey', 'earl of derby', 'colonel sibthorp', 'prime minister', 'prime minister', 'chancellor',
+                      'mr grey', 'mr grey', 'earl grey', 'sir robert'],
+            'source': [AliasCatalog.PEERAGE_TITLES, AliasCatalog.PEERAGE_TITLES, AliasCatalog.MILITARY_TITLES,
+                       AliasCatalog.OFFICES, AliasCatalog.OFFICES, AliasCatalog.OFFICES, AliasCatalog.SPEAKERS,
+                       AliasCatalog.SPEAKERS, AliasCatalog.SPEAKERS, AliasCatalog.SPEAKERS],
+            'member_id': [1, numpy.nan, 2, 3, 4, numpy.nan, 5, 6, 1, 7],
+            'start': pd.to_datetime(['1800-01-01', '1830-01-01', '1820-01-01', '1830-01-01', '1835-01-01', None,
+                                     '1800-01-01', '1830-01-01', '1800-01-01', None]),
+            'end': pd.to_datetime(['1845-01-01', '1870-01-01', '1860-01-01', '1835-01-01', '1841-01-01', None,
+                                   '1840-01-01', '1880-01-01', '1845-01-01', None]),
+        })
+        self.catalog = AliasCatalog(self.df['alias'], self.df['source'], self.df['member_id'],
+                                    self.df['start'].to_numpy(), self.df['end'].to_numpy())
+
+    def members(self, target, source, date, window=None):
+        return list(self.catalog.members(self.catalog.lookup(target), source, date, window))
+
+    def test_lookup(self):
+        df = self.df
+        for target in ('earl grey', 'earl', 'grey', 'colonel', 'prime minister', 'minister', 'mr grey', '', 'lord'):
+            for year in (1820, 1833, 1838, 1850):
+                date = pd.Timestamp(year=year, month=1, day=1)
+                valid = (date >= df['start']) & (date < df['end'])
+                for source in range(4):
+                    if source in AliasCatalog.CONTAINED:
+                        found = df['alias'].str.contains(target, regex=False)
+                    else:
+                        found = df['alias'] == target
+                    expected = df[valid & found & (df['source'] == source)]['member_id'].fillna(-1)
+                    members = numpy.nan_to_num(self.members(target, source, date), nan=-1)
+                    self.assertEqual(sorted(members), sorted(expected),
+                                     (target, year, source))
+
+        # Speakers keep the order they were given in.
+        self.assertEqual(self.members('mr grey', AliasCatalog.SPEAKERS, pd.Timestamp('1835-01-01')), [5, 6])
+
+    def test_has(self):
+        catalog = self.catalog
+        self.assertTrue(catalog.has(catalog.lookup('chancellor'), AliasCatalog.OFFICES))
+        self.assertEqual(self.members('chancellor', AliasCatalog.OFFICES, pd.Timestamp('1835-01-01')), [])
+        self.assertTrue(catalog.has(catalog.lookup('sir robert'), AliasCatalog.SPEAKERS))
+        self.assertFalse(catalog.has(catalog.lookup('sir'), AliasCatalog.SPEAKERS))
+        self.assertFalse(catalog.has(catalog.lookup('earl grey'), AliasCatalog.OFFICES))
+
+    def test_window(self):
+        window = DateWindow(pd.Timestamp('1833-01-01'))
+        self.members('prime minister', AliasCatalog.OFFICES, pd.Timestamp('1833-01-01'), window)
+        self.assertEqual((window.start, window.end), (pd.Timestamp('1830-01-01').value, pd.Timestamp('1835-01-01').value))
+
+        # Only the rows of the source asked for narrow the window.
+        window = DateWindow(pd.Timestamp('1833-01-01'))
+        self.members('grey', AliasCatalog.PEERAGE_TITLES, pd.Timestamp('1833-01-01'), window)
+        self.assertEqual((window.start, window.end), (pd.Timestamp('1800-01-01').value, pd.Timestamp('1845-01-01').value))
+
+
+class TestDatedAliasIndex(unittest.TestCase):
+    def test_positions(self):
+        from util.edit_distance import within_distance_two
+
+        df = pd.DataFrame({
+            'corresponding_id': [1, None, 3, 4, 5],
+            'alias': ['earl grey', 'earl grey', 'earl of derby', 'earl gray', 'lord stanley'],
+            'start_search': pd.to_datetime(['1800-06-01', '1830-01-01', '1845-01-01', '1850-01-01', None]),
+            'end_search': pd.to_datetime(['1845-01-01', '1850-01-01', '1845-01-01', '1900-01-01', None]),
+        })
+        index = DatedAliasIndex(df, 'alias')
+
+        for target in ('earl grey', 'earl gry', 'lord stanley', 'derby'):
+            for date in ('1800-01-01', '1800-06-01', '1844-12-31', '1845-01-01', '1849-12-31', '1850-01-01',
+                         '1900-01-01'):
+                date = pd.Timestamp(date)
+                expected = [position for position, row in enumerate(df.itertuples())
+                            if within_distance_two(row.alias, target, False)
+                            and row.start_search <= date < row.end_search]
+                window = DateWindow(date)
+                self.assertEqual(index.positions(target, date, window), expected, (target, date))
+
+                # The answer is the same on every date of the window.
+                for other in (window.start, window.end - 1):
+                    if numpy.iinfo(numpy.int64).min < other < numpy.iinfo(numpy.int64).max:
+                        self.assertEqual(index.positions(target, pd.Timestamp(other)), expected, (target, date))
+
+
+class TestOfficeAliasIndex(unittest.TestCase):
+    def test_lookup(self):
+        offices = [Office(1, 'Lord of the Treasury'), Office(2, 'First Lord of the Treasury'), Office(3, 'Speaker')]
+        index = OfficeAliasIndex(offices)
+
+        for target in ('lord of the treasury', 'lord treasury', 'first lord treasury', 'speaker', 'mr speaker', 'lord'):
+            exact = next((office.id for office in offices if target in office.aliases), None)
+            self.assertEqual(index.find(target), exact)
+
+    def test_within_distance(self):
+        from util.edit_distance import within_distance_four
+
+        offices = [Office(1, 'Lord of the Treasury'), Office(2, 'Chancellor of the Exchequer'), Office(3, 'Speaker')]
+        index = OfficeAliasIndex(offices)
+
+        for target in ('chancellor of exchequer', 'chancelor of the exchequr', 'chanc of the excheq', 'lord treasry',
+                       'speakr', 'spkr', 'mr speaker', 'sp', ''):
+            expected = [office.id for office in offices for alias in office.aliases
+                        if within_distance_four(alias, target, False)]
+            self.assertEqual(sorted(index.within_distance(target)), sorted(expected), target)
+
+
+class TestEditDistanceIndex(unittest.TestCase):
+    def test_search(self):
+        from util.edit_distance import within_distance_two
+
+        aliases = ['mr gladstone', 'mr w gladstone', 'mr william gladstone', 'sir robert peel', 'mr peel', 'mr smith',
+                   'mr smyth', 'lord john russell', 'mr russell', 'ab', 'abc', 'mr beale', 'mr o’connell', 'mr müller']
+        index = EditDistanceIndex(aliases, max_edits=2)
+
+        for target in ('mr gladstne', 'mr gladstone', 'mr gldstne', 'sir robert pell', 'mr peal', 'mr smth', 'mr',
+                       'a', '', 'abd', 'lord jon russel', 'mr russel', 'mr bale', 'mrpeel', 'mr o connel', 'mr o’conell',
+                       'mr muller', 'mr mùller'):
+            expected = [alias for alias in aliases if within_distance_two(target, alias, False)]
+            self.assertEqual(index.search(target), expected, target)
+
+
+class TestEditDistanceBatch(unittest.TestCase):
+    def test_matches_pairwise(self):
+        from util.edit_distance import PackedAliases, is_distance_one, within_distance_batch, within_distance_four, \
+            within_distance_two
+
+        aliases = ['mr gladstone', 'mr gladstne', 'sir robert peel', 'mr peel', 'mr peal', '', 'a', 'ab',
+                   'mr o’connell', 'mr o connell', 'lord john russell', 'mr russel']
+        packed = PackedAliases(aliases)
+        self.assertEqual(len(packed), len(aliases))
+
+        pairwise = {1: lambda a, b, allow_equal: is_distance_one(a, b) or (allow_equal and a == b),
+                    2: within_distance_two, 4: within_distance_four}
+        for target in ('mr gladstone', 'mr peel', 'mr o’conel', 'ab', '', 'lord jon russel'):
+            for n, distance_func in pairwise.items():
+                for allow_equal in (False, True):
+                    expected = [i for i, alias in enumerate(aliases) if distance_func(target, alias, allow_equal)]
+                    self.assertEqual(within_distance_batch(target, packed, n, allow_equal), expected, (target, n))
+                    self.assertEqual(within_distance_batch(target, packed, n, allow_equal, parallel=True), expected)
+
+        # Only the given positions are compared, in the order given.
+        self.assertEqual(within_distance_batch('mr peel', packed, 2, False, [4, 0, 3]), [4])
+        self.assertEqual(within_distance_batch('mr peel', packed, 2, True, [4, 0, 3]), [4, 3])
+
+
+def _greedy_edits(incorrect: str, correct: str, n: int, allow_equal: bool) -> bool:
+    # The kernel of util.edit_distance as it was written over UTF-8 bytes, which are the characters for ASCII.
+    len_i, len_c = len(incorrect), len(correct)
+    if abs(len_i - len_c) > n:
+        return False
+    i = j = count = 0
+    while i < len_i and j < len_c:
+        if incorrect[i] == correct[j]:
+            i += 1
+            j += 1
+        else:
+            if count >= n:
+                return False
+            if len_i == len_c:
+                i += 1
+                j += 1
+            else:
+                i += len_i > len_c
+                j += len_c > len_i
+            count += 1
+    if i < len_i or j < len_c:
+        count += abs(len_i - len_c)
+    return bool((allow_equal and not count) or (count and count <= n))
+
+
+class TestCodePointKernels(unittest.TestCase):
+    def test_ascii_unchanged(self):
+        from util.edit_distance import is_distance_one, within_distance_four, within_distance_two
+
+        rng = random.Random(0)
+        words = [''.join(rng.choice('abc d.') for _ in range(rng.randint(0, 10))) for _ in range(300)]
+        for _ in range(5000):
+            a, b = rng.choice(words), rng.choice(words)
+            self.assertEqual(is_distance_one(a, b), _greedy_edits(a, b, 1, False), (a, b))
+            for allow_equal in (False, True):
+                self.assertEqual(within_distance_two(a, b, allow_equal), _greedy_edits(a, b, 2, allow_equal), (a, b))
+                self.assertEqual(within_distance_four(a, b, allow_equal), _greedy_edits(a, b, 4, allow_equal), (a, b))
+
+    def test_code_points(self):
+        from util.edit_distance import is_distance_one, within_distance_two
+        from util.jaro_distance import jaro_distance
+
+        # One character apart, whatever the number of bytes it takes in UTF-8 (1, 2, 3 or 4).
+        for accented in ('mr muller', 'mr müller', 'mr m’ller', 'mr m\U0001d518ller'):
+            self.assertTrue(is_distance_one('mr mxller', accented), accented)
+            self.assertEqual(jaro_distance('mr mxller', accented), jaro_distance('mr mxller', 'mr muller'))
+        self.assertTrue(within_distance_two('o’connell', 'o connell', False))
+        self.assertEqual(jaro_distance('müller', 'müller'), 1.0)
+
+
+class TestBestGuessIndex(unittest.TestCase):
+    def test_search(self):
+        names = ['mr gladstone', 'mr gladstone', 'mr w gladstone', 'earl of derby', 'lord john russell']
+        starts = pd.to_datetime(['1830-01-01', '1860-01-01', '1840-01-01', '1800-01-01', '1800-01-01']).to_numpy()
+        ends = pd.to_datetime(['1850-01-01', '1870-01-01', '1900-01-01', '1900-01-01', '1900-01-01']).to_numpy()
+        index = BestGuessIndex(names, starts, ends)
+        self.assertEqual(index.names, ['mr gladstone', 'mr w gladstone', 'earl of derby', 'lord john russell'])
+
+        date = datetime.datetime(1845, 1, 1)
+        window = DateWindow(date)
+        guess, score = index.search('mr gladstne', date, window)
+        self.assertEqual((guess, score), ('mr gladstone', jaro_distance('mr gladstne', 'mr gladstone')))
+        self.assertEqual((window.start, window.end), (pd.Timestamp('1840-01-01').value, pd.Timestamp('1850-01-01').value))
+
+        # Only names valid on the date are guessed.
+        self.assertEqual(index.search('mr gladstne', datetime.datetime(1855, 1, 1))[0], 'mr w gladstone')
+        self.assertEqual(index.search('lord jon russel', date)[0], 'lord john russell')
+        self.assertEqual(index.search('lord jon russel', datetime.datetime(1900, 1, 1)), (None, 0.0))
+        self.assertEqual(index.search('xyzzy', date), (None, 0.0))
+        self.assertEqual(index.search('mr derby', date), (None, 0.0))
+
+    def test_candidate_budget(self):
+        names = [f'mr smith{i:03}' for i in range(100)]
+        dates = numpy.full(len(names), numpy.datetime64('1800-01-01', 'ns'))
+        index = BestGuessIndex(names, dates, dates + numpy.timedelta64(365 * 200, 'D'), max_candidates=10)
+        candidates = index.candidates('mr smith042')
+        self.assertEqual(len(candidates), 10)
+        self.assertIn(42, candidates)
+
+        # The names blocked in are what the worker charges to the chunk budget.
+        index.search('mr smith042', datetime.datetime(1850, 1, 1))
+        index.search('xyzzy', datetime.datetime(1850, 1, 1))
+        self.assertEqual(index.stats()['blocked'], 10)
+
 
 from hansard.disambiguate import HOUSE_OF_LORDS, HOUSE_OF_COMMONS, disambiguate
-from hansard.loader import DataStruct
+from hansard.loader import DataStruct, single_speaker_segments
+
+
+class TestSingleSpeakerSegments(unittest.TestCase):
+    def test_segments(self):
+        a = SpeakerReplacement('a b', 'a', 'b', 1, datetime.datetime(1800, 1, 1), datetime.datetime(1850, 1, 1))
+        b = SpeakerReplacement('a b', 'a', 'b', 2, datetime.datetime(1840, 1, 1), datetime.datetime(1860, 1, 1))
+        segments = single_speaker_segments([a, b])
+        # Inclusive end dates become exclusive one nanosecond later.
+        tick = pd.Timedelta(1, 'ns')
+        self.assertEqual(segments, [(pd.Timestamp('1800-01-01'), pd.Timestamp('1840-01-01')),
+                                    (pd.Timestamp('1850-01-01') + tick, pd.Timestamp('1860-01-01') + tick)])
 
 
 class TestDisambiguate(unittest.TestCase):
@@ -0,0 +1,181 @@
+import multiprocessing
+import pickle
+import sys
+import time
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+
+def frame_nbytes(frame: pd.DataFrame, sample: int = 1024) -> int:
+    # Memory held by a frame, the strings of object columns estimated from an even sample of them.
+    nbytes = frame.index.nbytes
+    for _, column in frame.items():
+        values = column.to_numpy()
+        nbytes += values.nbytes
+        if values.dtype == object and len(values):
+            step = max(len(values) // sample, 1)
+            nbytes += sum(map(sys.getsizeof, values[::step])) * len(values) // len(values[::step])
+    return nbytes
+
+
+class SharedFrame:
+    """
+    A DataFrame handed to another process through a shared memory segment, only this descriptor goes through the
+    queue.
+
+    The frame is pickled (protocol 5) with its numeric columns out of band, and the pickle and the column buffers
+    are written one after the other into a new segment. `load` rebuilds the frame in the receiving process and
+    unlinks the segment, so a SharedFrame is loaded once. A segment never loaded (its reader was killed) is unlinked
+    by the resource tracker when the run ends, as long as every process shares the tracker of the main process.
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        buffers = []
+        payload = pickle.dumps(frame, protocol=5, buffer_callback=buffers.append)
+        parts = [memoryview(payload)] + [buffer.raw() for buffer in buffers]
+
+        # Size of the pickle then of every buffer.
+        self.sizes: List[int] = [part.nbytes for part in parts]
+
+        memory = shared_memory.SharedMemory(create=True, size=max(sum(self.sizes), 1))
+        offset = 0
+        for part in parts:
+            memory.buf[offset:offset + part.nbytes] = part
+            offset += part.nbytes
+        self.name: str = memory.name
+        memory.close()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self.sizes)
+
+    def load(self) -> pd.DataFrame:
+        memory = shared_memory.SharedMemory(name=self.name)
+        try:
+            # Copied out so the segment can go right away, the buffers stay writable like any other column.
+            parts = []
+            offset = 0
+            for size in self.sizes:
+                parts.append(bytearray(memory.buf[offset:offset + size]))
+                offset += size
+        finally:
+            memory.close()
+            memory.unlink()
+        return pickle.loads(parts[0], buffers=parts[1:])
+
+
+class ReorderWindow:
+    """
+    Keeps the chunks being worked on within `size` sequence numbers of the first chunk not exported yet, so an
+    exporter writing chunks in order buffers fewer than `size` of them.
+
+    The process handing out chunks calls `admit` before each one, the exporter calls `advance` with the sequence
+    number of the next chunk it is waiting for. A chunk that never reaches the exporter (its worker died) would hold
+    the window forever, so a waiting `admit` calls `release_if` every `interval` seconds and once it returns True the
+    window is released: it holds back no chunk from then on.
+    """
+
+    def __init__(self, size: int):
+        if size <= 0:
+            raise ValueError('size must be positive')
+        self.size = size
+
+        self._condition = multiprocessing.Condition()
+        self._next = multiprocessing.Value('q', 0, lock=False)
+        self._released = multiprocessing.Value('b', 0, lock=False)
+
+        self.stalls = 0
+        self.stall_seconds = 0.0
+
+    @property
+    def released(self) -> bool:
+        return bool(self._released.value)
+
+    def _fits(self, sequence: int) -> bool:
+        return self._released.value or sequence < self._next.value + self.size
+
+    def admit(self, sequence: int, release_if: Optional[Callable[[], bool]] = None, interval: float = 1.0):
+        with self._condition:
+            if not self._fits(sequence):
+                start = time.perf_counter()
+                while not self._condition.wait_for(lambda: self._fits(sequence), interval):
+                    if release_if is not None and release_if():
+                        self._released.value = 1
+                        self._condition.notify_all()
+                self.stalls += 1
+                self.stall_seconds += time.perf_counter() - start
+
+    def advance(self, sequence: int):
+        with self._condition:
+            self._next.value = sequence
+            self._condition.notify_all()
+
+
+class AdmissionQueue:
+    """
+    A queue of chunks from one process to the workers, holding at most `max_chunks` chunks and `max_bytes` bytes
+    that no worker has taken yet. `put` blocks until the chunk fits, a chunk larger than max_bytes is let in once the
+    queue is empty.
+
+    The putting process counts the puts, the ones that had to wait and how long for, and the depth (chunks waiting)
+    each put left the queue at. As in ReorderWindow, a waiting `put` calls `release_if` every `interval` seconds and
+    once it returns True the queue stops bounding the chunks waiting (no worker is left to take them).
+    """
+
+    def __init__(self, max_chunks: int, max_bytes: int):
+        if max_chunks <= 0 or max_bytes <= 0:
+            raise ValueError('max_chunks and max_bytes must be positive')
+        self.max_chunks = max_chunks
+        self.max_bytes = max_bytes
+
+        self._queue = multiprocessing.Queue()
+        self._condition = multiprocessing.Condition()
+        # Chunks and bytes put and not taken yet, only changed with the condition held.
+        self._chunks = multiprocessing.Value('q', 0, lock=False)
+        self._bytes = multiprocessing.Value('q', 0, lock=False)
+        self._released = multiprocessing.Value('b', 0, lock=False)
+
+        self.puts = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.bytes_max = 0
+
+    def _fits(self, nbytes: int) -> bool:
+        chunks = self._chunks.value
+        return not chunks or self._released.value or (chunks < self.max_chunks and
+                                                      self._bytes.value + nbytes <= self.max_bytes)
+
+    def put(self, chunk, nbytes: int = 0, release_if: Optional[Callable[[], bool]] = None, interval: float = 1.0):
+        with self._condition:
+            if not self._fits(nbytes):
+                start = time.perf_counter()
+                while not self._condition.wait_for(lambda: self._fits(nbytes), interval):
+                    if release_if is not None and release_if():
+                        self._released.value = 1
+                        # Nothing will read what is left in the pipe, exiting must not wait to flush it.
+                        self._queue.cancel_join_thread()
+                self.stalls += 1
+                self.stall_seconds += time.perf_counter() - start
+            self._chunks.value += 1
+            self._bytes.value += nbytes
+            self.puts += 1
+            self.depth_total += self._chunks.value
+            self.depth_max = max(self.depth_max, self._chunks.value)
+            self.bytes_max = max(self.bytes_max, self._bytes.value)
+        self._queue.put((chunk, nbytes))
+
+    def get(self, block: bool = True, timeout: float = None):
+        chunk, nbytes = self._queue.get(block, timeout)
+        with self._condition:
+            self._chunks.value -= 1
+            self._bytes.value -= nbytes
+            self._condition.notify_all()
+        return chunk
+
+    def stats(self) -> Dict[str, float]:
+        return {'puts': self.puts, 'stalls': self.stalls, 'stall_seconds': self.stall_seconds,
+                'depth_total': self.depth_total, 'depth_max': self.depth_max, 'bytes_max': self.bytes_max}
@@ -1,21 +1,36 @@
+import hashlib
 import multiprocessing
 from queue import Empty
 from typing import Tuple, Optional, List, Dict
 
 import numpy
 
+from hansard.cache import IntervalCache, LRUMemo, NegativeCache, PersistentResolutionCache, SharedIntervalCache
+from hansard.corrections import LiteralCorrector, RegexCorrector
+from hansard import disambiguate as disambiguate_module, speaker as speaker_module
 from hansard.disambiguate import disambiguate
+from hansard.index import AliasCatalog, DatedAliasIndex, DateWindow
 from hansard.loader import DataStruct
 from datetime import datetime
 import pandas as pd
 import re
+import time
 
 from hansard.speaker import SpeakerReplacement
-from util.edit_distance import within_distance_four, within_distance_two, is_distance_one
+from hansard.transport import SharedFrame
 
 
 OUTPUT_COLUMN = 'suggested_speaker'
 
+# Maximum number of raw speaker strings whose preprocessed form is kept by each worker.
+PREPROCESS_CACHE_SIZE = 2**18
+
+# Memory budget (estimated bytes) of each worker's resolution cache.
+RESULT_CACHE_BYTES = 2**30
+
+# Memory budget (estimated bytes) of each worker's best guess cache.
+BEST_GUESS_CACHE_BYTES = 2**27
+
 compile_regex = lambda x: (re.compile(x[0]), x[1])
 
 PRE_CORRECTIONS = [
@@ -264,6 +279,8 @@ PRE_CORRECTIONS = [
     ('COUNCIL ON EDU-', 'Council of Education')
 ]
 
+PRE_CORRECTOR = LiteralCorrector(PRE_CORRECTIONS)
+
 
 REGEX_PRE_CORRECTIONS = [
     # Remove all text within parenthesis, including parenthesis
@@ -673,6 +690,8 @@ REGEX_POST_CORRECTIONS = [
 
 REGEX_POST_CORRECTIONS = list(map(compile_regex, REGEX_POST_CORRECTIONS))
 
+POST_CORRECTOR = RegexCorrector(REGEX_POST_CORRECTIONS)
+
 IGNORE_KEYWORDS = (
     #'member',
     #'membee',
@@ -693,6 +712,33 @@ IGNORE_PREFIXES = (
 )
 
 
+# Bump whenever resolve() or another module it calls changes how a result is worked out, so persisted resolutions
+# are not reused. Edits to the modules in RULE_MODULES are picked up without a bump.
+RESOLUTION_VERSION = 1
+
+# Modules whose whole source goes into rules_version: the disambiguation rules and the alias generation.
+RULE_MODULES = (disambiguate_module, speaker_module)
+
+
+def rules_version() -> str:
+    # Content hash of the correction and ignore tables above, of RESOLUTION_VERSION and of RULE_MODULES.
+    sources = []
+    for module in RULE_MODULES:
+        with open(module.__file__, 'rb') as f:
+            sources.append(hashlib.sha256(f.read()).hexdigest())
+    tables = (
+        RESOLUTION_VERSION,
+        sources,
+        PRE_CORRECTIONS,
+        [(regex.pattern, replacement) for regex, replacement in REGEX_PRE_CORRECTIONS],
+        [(regex.pattern, replacement) for regex, replacement in REGEX_POST_CORRECTIONS],
+        PARENTHESIS_REGEX.pattern,
+        IGNORE_KEYWORDS,
+        IGNORE_PREFIXES,
+    )
+    return hashlib.sha256(repr(tables).encode()).hexdigest()
+
+
 def is_ignored(target: str) -> bool:
     if len(target) < 35:  # temp check: some speaker column values contain debate text
         for kw in IGNORE_KEYWORDS:
@@ -709,91 +755,55 @@ def match_term(df: pd.DataFrame, date: datetime) -> pd.DataFrame:
     return df[(date >= df['start_search']) & (date < df['end_search'])]
 
 
-def match_edit_distance_df(target: str,  date: datetime, df: pd.DataFrame,
-                           columns: Tuple[str, str, str], speaker_dict: Dict[int, SpeakerReplacement],
-                           edit_dist_func=within_distance_two) -> Tuple[Optional[str], bool, List[str]]:
-    start_col, end_col, search_col = columns
-
+def match_edit_distance_df(target: str,  date: datetime, index: DatedAliasIndex,
+                           speaker_dict: Dict[int, SpeakerReplacement],
+                           window: Optional[DateWindow] = None) -> Tuple[Optional[str], bool, List[str]]:
     match = None
     ambiguity = False
     possibles = []
     max_possibles = 5
 
-    condition = (date >= df[start_col]) & (date < df[end_col])
-    query = df[condition]
+    aliases = index.values
+    ids = index.ids
 
-    for i, alias in enumerate(query[search_col]):
-        if edit_dist_func(target, alias, False):
-            if match:
-                ambig_match = query.iloc[i]['corresponding_id']
-                if numpy.isnan(ambig_match):
-                    ambig_match = alias
-                else:
-                    ambig_match = speaker_dict[int(ambig_match)]
-                max_possibles -= 1
-                match = None
-                ambiguity = True
-                possibles.append(ambig_match)
-                if not max_possibles:
-                    break
+    for position in index.positions(target, date, window):
+        alias = aliases[position]
+        if match:
+            ambig_match = ids[position]
+            if numpy.isnan(ambig_match):
+                ambig_match = alias
             else:
-                match = query.iloc[i]['corresponding_id']
-                if numpy.isnan(match):
-                    match = alias
-                else:
-                    match = speaker_dict[int(match)]
-                # print('edit distance found. target=%s match=%s' % (target, repr(match)))
+                ambig_match = speaker_dict[int(ambig_match)]
+            max_possibles -= 1
+            match = None
+            ambiguity = True
+            possibles.append(ambig_match)
+            if not max_possibles:
+                break
+        else:
+            match = ids[position]
+            if numpy.isnan(match):
+                match = alias
+            else:
+                match = speaker_dict[int(match)]
+            # print('edit distance found. target=%s match=%s' % (target, repr(match)))
 
     return match, ambiguity, possibles
 
 
-from util.jaro_distance import jaro_distance
-
-
-def find_best_jaro_dist_df(target: str, df: pd.DataFrame, speechdate: datetime, curr_best, col: str, date_start_col='start_search',
-                           date_end_col='end_search'):
-    condition = (speechdate >= df[date_start_col]) & \
-                (speechdate < df[date_end_col])
-    query = df[condition]
-
-    for row in query.itertuples(index=False):
-        dist = jaro_distance(target, getattr(row, col))
-        if dist > curr_best[1]:
-            curr_best = [getattr(row, col), dist]
-    return curr_best
-
-
-def find_best_jaro_dist(target: str, alias_dict: Dict[str, List[SpeakerReplacement]],
-                        honorary_title_df: pd.DataFrame,
-                        lord_titles_df: pd.DataFrame,
-                        aliases_df: pd.DataFrame,
-                        speechdate: datetime):
-    best_match = ['', 0.0]
-
-    best_match = find_best_jaro_dist_df(target, honorary_title_df, speechdate, best_match, 'honorary_title',
-                                        'start_search', 'end_search')
-    best_match = find_best_jaro_dist_df(target, lord_titles_df, speechdate, best_match, 'alias')
-    best_match = find_best_jaro_dist_df(target, aliases_df, speechdate, best_match, 'alias')
-
-    for alias in alias_dict:
-        dist = jaro_distance(target, alias)
-        if dist > best_match[1]:
-            possibles = alias_dict[alias]
-            possibles = [speaker for speaker in possibles if speaker.matches(target, speechdate, cleanse=False)]
-            if len(possibles) == 1:
-                best_match = [alias, dist]
-
-    return best_match
-
-
 # This function will run per core.
 def worker_function(inq: multiprocessing.Queue,
                     outq: multiprocessing.Queue,
-                    data: DataStruct):
+                    data: DataStruct,
+                    shared_cache: Optional[SharedIntervalCache] = None,
+                    persistent_cache: Optional[PersistentResolutionCache] = None,
+                    negative_cache: Optional[NegativeCache] = None,
+                    shared_frames: bool = False,
+                    best_guess_budget: float = float('inf')):
     from . import cleanse_string
 
     # Lookup optimization
-    misspellings_dict = data.corrections
+    misspellings = LiteralCorrector(data.corrections.items())
     alias_dict = data.alias_dict
     terms_df = data.term_df
     speaker_dict = data.speaker_dict
@@ -802,41 +812,41 @@ def worker_function(inq: multiprocessing.Queue,
     office_dict = data.office_dict
     lord_titles_df = data.lord_titles_df
     aliases_df = data.aliases_df
+    alias_catalog = data.alias_catalog
+    lord_titles_aliases = data.lord_titles_aliases
     title_df = data.title_df
     holdings_df = data.holdings_df
+    holdings_index = data.holdings_index
+    office_index = data.office_index
 
     hitcount = 0
 
-    fuzzy_flag = 0
-
-    MATCH_CACHE = {}  # (target, speechdate) -> suggested speaker
-    MISS_CACHE = set()  # (target, speechdate)
-    AMBIG_CACHE = {}  # (target, speechdate) -> suggested speakers
-    IGNORED_CACHE = set()  # (target, speechdate)
-    FUZZY_CACHE = set()   # (target, speechdate)
-
-    edit_distance_dict = {}  # alias -> list[speaker id's]
-
-    extended_edit_distance_set = set()
-
-    i = 0
-    speechdate = None
-    target = None
-    debate_id = None
-    ignored = False
-    office_id = None
-
-    for speaker in data.speakers:
-        # if len(speaker.last_name) > 8:
-        #     for alias in speaker.generate_edit_distance_aliases():
-        #         extended_edit_distance_set.add(alias)
-        for alias in speaker.generate_edit_distance_aliases():
-            edit_distance_dict.setdefault(alias, []).append(speaker.member_id)
+    # target -> (suggested speaker(s), ambiguous, fuzzy flag), for the dates the resolution holds over.
+    RESULT_CACHE = IntervalCache(RESULT_CACHE_BYTES)
+
+    # Unresolved target -> (best guess, score), for the dates the guess holds over.
+    best_guess_index = data.best_guess_index
+    BEST_GUESS_CACHE = IntervalCache(BEST_GUESS_CACHE_BYTES)
+
+    edit_distance_dict = data.edit_distance_dict
+    edit_distance_index = data.edit_distance_index
+
+    # Counters reported to the export process, as the change over each chunk.
+    stat_sources = {'edit_distance': edit_distance_index, 'fuzzy_office': office_index.fuzzy,
+                    'fuzzy_lord_titles': lord_titles_aliases.fuzzy,
+                    'result_cache': RESULT_CACHE}
+    if shared_cache is not None:
+        stat_sources['shared_cache'] = shared_cache
+    if persistent_cache is not None:
+        stat_sources['persistent_cache'] = persistent_cache
+    if negative_cache is not None:
+        stat_sources['negative_cache'] = negative_cache
+    if best_guess_index is not None:
+        stat_sources['best_guess'] = best_guess_index
+        stat_sources['best_guess_cache'] = BEST_GUESS_CACHE
 
     def postprocess(string_val: str) -> str:
-        for k, v in REGEX_POST_CORRECTIONS:
-            string_val = re.sub(k, v, string_val)
-        return string_val.strip()
+        return POST_CORRECTOR.apply(string_val).strip()
 
     def preprocess(string_val: str) -> str:
         # Decide whether to use the text inside parenthesis or not.
@@ -847,286 +857,382 @@ def worker_function(inq: multiprocessing.Queue,
             if inner_string in alias_dict:  # is this a speaker name?
                 return inner_string
 
-        for k, v in PRE_CORRECTIONS:
-            string_val = string_val.replace(k, v)
+        string_val = PRE_CORRECTOR.apply(string_val)
 
         for k, v in REGEX_PRE_CORRECTIONS:
             string_val = re.sub(k, v, string_val)
 
         string_val = cleanse_string(string_val)
-        for misspell in misspellings_dict:
-            string_val = string_val.replace(misspell, misspellings_dict[misspell])
+        string_val = misspellings.apply(string_val)
         string_val = cleanse_string(string_val)
         return postprocess(string_val)
 
-    while True:
-        try:
-            chunk: pd.DataFrame = inq.get(block=True)
-        except Empty:
-            continue
-        else:
-            if chunk is None:
-                # This is our signal that we are done here. Every other worker thread will get a similar signal.
-                return
+    preprocess_memo = LRUMemo(preprocess, PREPROCESS_CACHE_SIZE)
+
+    def preprocess_column(speakers: pd.Series) -> Tuple[numpy.ndarray, int]:
+        # Preprocess every distinct speaker value once and broadcast the result back to its rows.
+        codes, uniques = pd.factorize(speakers)
+        # Missing speakers are coded as -1, which picks up the trailing None, resolve ignores them.
+        targets = numpy.array([preprocess_memo(val) for val in uniques] + [None], dtype=object)
+        return targets[codes], len(uniques)
+
+    def resolve(target: Optional[str], speechdate: datetime, speaker_house: int,
+                debate_id) -> Tuple[Optional[str], int, int, int]:
+        # Returns the (suggested speaker, ambiguous, fuzzy matched, ignored) values for every row sharing this key.
+
+        # check if we should ignore this row. This is cheaper than any cache lookup. Rows without a speaker are
+        # ignored too.
+        if target is None or is_ignored(target) or target in data.ignored_set:
+            return None, 0, 0, 1
+
+        # Every date lookup below narrows the window to the dates giving the same answer as speechdate.
+        window = DateWindow(speechdate)
+        context = f'{speaker_house}|{debate_id}'
+        cached = RESULT_CACHE.get(target, window.date)
+        if cached is None and negative_cache is not None and target in negative_cache:
+            return None, 0, 0, 0
+        for cache in (shared_cache, persistent_cache):
+            if cached is None and cache is not None:
+                stored = cache.get(target, window.date)
+                if stored is not None:
+                    start, end, cached = stored
+                    RESULT_CACHE.put(target, start, end, cached)
+        if cached is None and persistent_cache is not None:
+            cached = persistent_cache.get_context(target, window.date, context)
+            if cached is not None:
+                RESULT_CACHE.put(target, window.date, window.date + 1, cached)
+        if cached is not None:
+            suggestion, ambiguous, fuzzy_flag = cached
+            return suggestion, ambiguous, fuzzy_flag, 0
+
+        cache_target = target
+        # Data sources (see DATA_SOURCES and rules_version) the result is worked out from.
+        sources = {'rules', 'non_mps'}
+
+        fuzzy_flag = 0
+        match = None
+        ambiguity: bool = False
+        possibles = []
+        query = []
+
+        # if not match and not len(query):
+        #     # Try honorary title
+        #     condition = (speechdate >= honorary_title_df['start_search']) &\
+        #                 (speechdate < honorary_title_df['end_search']) &\
+        #                 (honorary_title_df['honorary_title'].str.contains(target, regex=False))
+        #     query = honorary_title_df[condition]
+
+        # Rows of every exact source for the target, each stage below keeps the ones of its source.
+        rows = alias_catalog.lookup(target)
+
+        if not match and not len(query):
+            # try lord/viscount/earl aliases.
+            sources.add('peerage_titles')
+            query = alias_catalog.members(rows, AliasCatalog.PEERAGE_TITLES, speechdate, window)
+
+        if not match and not len(query):
+            # try name aliases.
+            sources.add('military_titles')
+            query = alias_catalog.members(rows, AliasCatalog.MILITARY_TITLES, speechdate, window)
+
+        # if not match and not len(query):
+        #     # try a lord title/alias
+        #     condition = (speechdate >= title_df['start_search']) &\
+        #                 (speechdate < title_df['end_search']) &\
+        #                 (title_df['alias'].str.contains(target, regex=False))
+        #     query = title_df[condition]
+
+        # if not match and not len(query):
+        #     # Try office position
+        #     for position in office_title_dfs:
+        #         if position in target:
+        #             query = match_term(office_title_dfs[position], speechdate)
+        #             break
+        #         if within_distance_four(position, target, True):
+        #             fuzzy_flag = 1
+        #             query = match_term(office_title_dfs[position], speechdate)
+        #             break
+
+        if not match and not len(query):
+            sources.add('offices')
+
+            if alias_catalog.has(rows, AliasCatalog.OFFICES):
+                sources.update(('holdings', 'speakers'))
+                query = alias_catalog.members(rows, AliasCatalog.OFFICES, speechdate, window)
+
+        if not match:
+            query = pd.unique(query)
+            if len(query) == 1:
+                speaker_id = query[0]
+                sources.add('speakers')
+                if speaker_id != 'N/A' and not numpy.isnan(speaker_id):
+                    # TODO: setup logging to keep track of when == n/a
+                    # TODO: fix IDs missing due to being malformed entries in speakers.csv
+                    # match = speaker_dict[int(speaker_id)]
+                    # for now use speaker_id to ensure this counts as a match
+                    try:
+                        match = speaker_dict[int(speaker_id)]
+                    except KeyError as e:
+                        print('failed lookup', query)
+                        match = None
+                        ambiguity = False
 
-            chunk[OUTPUT_COLUMN] = chunk['speaker'].map(preprocess)
-            chunk['ambiguous'] = 0
-            chunk['fuzzy_matched'] = 0
-            chunk['ignored'] = 0
+            elif len(query) > 1:
+                ambiguity = True
 
-            for row in chunk.itertuples():
-                fuzzy_flag = 0
-                i = row[0]
-                speechdate = row.speechdate
-                # unmodified_target = row.speaker
-                target = getattr(row, OUTPUT_COLUMN)
-                debate_id = int(row.debate_id)
-                office_id = None
+        if not match:
+            sources.add('speakers')
+            if alias_catalog.has(rows, AliasCatalog.SPEAKERS):
+                possibles = [speaker_dict[int(member_id)] for member_id in
+                             alias_catalog.members(rows, AliasCatalog.SPEAKERS, speechdate, window)]
+                if len(possibles) == 1:
+                    match = possibles[0]
+                    ambiguity = False
+                else:
+                    ambiguity = True
+            else:
+                possibles = []
 
-                if(target, speechdate) in FUZZY_CACHE:
-                    chunk.loc[i, 'fuzzy_matched'] = 1
+        # Try edit distance with lord titles.
+        if not match and not ambiguity:
+            sources.update(('peerage_titles', 'speakers'))
+            match, ambiguity, possibles = match_edit_distance_df(target, speechdate, lord_titles_aliases, speaker_dict,
+                                                                 window=window)
+
+            if match: fuzzy_flag = 1
+
+        # if not match and not ambiguity:
+        #     match, ambiguity = match_edit_distance_df(target, speechdate, title_df,
+        #                                               ('start_search', 'start_search', 'alias'), speaker_dict)
+        #     if match: fuzzy_flag = 1
+
+        # Try edit distance with honorary titles.
+        # if not match and not ambiguity:
+        #     match, ambiguity = match_edit_distance_df(target, speechdate, honorary_title_df,
+        #                                               ('start_search', 'end_search', 'honorary_title'),
+        #                                               speaker_dict)
+        #     if match: fuzzy_match_indexes.append(i)
+
+        # Try edit distance with office holdings.
+        if not match and not ambiguity:
+            sources.add('offices')
+            office_ids = office_index.within_distance(target)
+
+            if office_ids:
+                sources.update(('holdings', 'speakers'))
+                query = holdings_index.query(office_ids, speechdate, window)
+
+                if len(query) == 1:
+                    match = query.iloc[0]['corresponding_id']
+                    if not numpy.isnan(match) and type(match) != str:
+                        match = speaker_dict[int(match)]
+                    else:
+                        match = None
+                        ambiguity = False
+                elif len(query) > 1:
+                    match = None
+                    ambiguity = True
+
+                if match: fuzzy_flag = 1
+
+        # Try edit distance with MP name permutations.
+        if not match and not ambiguity:
+            # Remove initials. (Even if we did consider initials, it would cause more unnecessary ambiguities.)
+            target = re.sub(r'\b[a-z]\b', '', target)
+            # Fix multiple whitespace from previous regex.
+            target = re.sub(r'  +', ' ', target)
+
+            possibles = []
+            for alias in edit_distance_index.search(target):
+                # if len(possibles) > 1:
+                #     break
+                for speaker_id in edit_distance_dict[alias]:
+                    speaker = speaker_dict[speaker_id]
+                    window.add_interval(speaker.start_date, speaker.end_date, closed=True)
+                    if speaker.start_date <= speechdate <= speaker.end_date:
+                        fuzzy_flag = 1
+                        possibles.append(speaker)
 
-                if (target, speechdate) in MISS_CACHE:
-                    chunk.loc[i, OUTPUT_COLUMN] = None
-                    continue
-                elif (target, speechdate) in AMBIG_CACHE:
-                    chunk.loc[i, OUTPUT_COLUMN] = AMBIG_CACHE[(target, speechdate)]
-                    chunk.loc[i, 'ambiguous'] = 1
-                    continue
-                elif target in IGNORED_CACHE:
-                    chunk.loc[i, OUTPUT_COLUMN] = None
-                    chunk.loc[i, 'ignored'] = 1
-                    continue
+            if len(possibles) == 1:
+                match = possibles[0]
+                ambiguity = False
+            elif len(possibles) > 1:
+                ambiguity = True
 
-                match = MATCH_CACHE.get((target, speechdate), None)
-                ambiguity: bool = False
+        if ambiguity:
+            # Settled by the debate, house and exact date from here on, so the result only holds for speechdate
+            # (and is shared by every debate on it, as before).
+            window.collapse()
+            sources.update(('inferences', 'speakers', 'terms'))
+
+        if ambiguity and possibles:
+            match = speaker_dict.get(data.inferences.get(int(debate_id), None), None)
+            if match not in possibles:
+                match = None
+            else:
+                ambiguity = False
                 possibles = []
-                query = []
-
-                # check if we should ignore this row.
-                if not match:
-                    ignored = is_ignored(target) or target in data.ignored_set
-
-                    if ignored:
-                        IGNORED_CACHE.add(target)
-                        chunk.loc[i, OUTPUT_COLUMN] = None
-                        chunk.loc[i, 'ignored'] = 1
-                        continue  # continue onto the next speaker
-
-                # if not match and not len(query):
-                #     # Try honorary title
-                #     condition = (speechdate >= honorary_title_df['start_search']) &\
-                #                 (speechdate < honorary_title_df['end_search']) &\
-                #                 (honorary_title_df['honorary_title'].str.contains(target, regex=False))
-                #     query = honorary_title_df[condition]
-
-                if not match and not len(query):
-                    # try lord/viscount/earl aliases.
-                    condition = (speechdate >= lord_titles_df['start_search']) &\
-                                (speechdate < lord_titles_df['end_search']) &\
-                                (lord_titles_df['alias'].str.contains(target, regex=False))
-                    query = lord_titles_df[condition]
-
-                if not match and not len(query):
-                    # try name aliases.
-                    condition = (speechdate >= aliases_df['start_search']) &\
-                                (speechdate < aliases_df['end_search']) &\
-                                (aliases_df['alias'].str.contains(target, regex=False))
-                    query = aliases_df[condition]
-
-                # if not match and not len(query):
-                #     # try a lord title/alias
-                #     condition = (speechdate >= title_df['start_search']) &\
-                #                 (speechdate < title_df['end_search']) &\
-                #                 (title_df['alias'].str.contains(target, regex=False))
-                #     query = title_df[condition]
-
-                # if not match and not len(query):
-                #     # Try office position
-                #     for position in office_title_dfs:
-                #         if position in target:
-                #             query = match_term(office_title_dfs[position], speechdate)
-                #             break
-                #         if within_distance_four(position, target, True):
-                #             fuzzy_flag = 1
-                #             query = match_term(office_title_dfs[position], speechdate)
-                #             break
-
-                if not match and not len(query):
-                    for office in data.office_dict.values():
-                        if target in office.aliases:
-                            office_id = office.id
-                            break
-                        for alias in office.aliases:
-                            if alias in target:
-                                office_id = office_id
-                                break
-
-                    if office_id:
-                        condition = (speechdate >= holdings_df['start_search']) & \
-                                    (speechdate < holdings_df['end_search']) & \
-                                    (office_id == holdings_df['office_id'])
-                        query = holdings_df[condition]
-
-                if not match:
-                    query = query.drop_duplicates(subset=['corresponding_id'])
-                    if len(query) == 1:
-                        speaker_id = query.iloc[0]['corresponding_id']
-                        if speaker_id != 'N/A' and not numpy.isnan(speaker_id):
-                            # TODO: setup logging to keep track of when == n/a
-                            # TODO: fix IDs missing due to being malformed entries in speakers.csv
-                            # match = speaker_dict[int(speaker_id)]
-                            # for now use speaker_id to ensure this counts as a match
-                            try:
-                                match = speaker_dict[int(speaker_id)]
-                            except KeyError as e:
-                                print('failed lookup', query)
-                                match = None
-                                ambiguity = False
-
-                    elif len(query) > 1:
-                        ambiguity = True
-
-                if not match:
-                    possibles = alias_dict.get(target)
-                    if possibles is not None:
-                        possibles = [speaker for speaker in possibles if speaker.matches(target, speechdate, cleanse=False)]
-                        if len(possibles) == 1:
-                            match = possibles[0]
-                            ambiguity = False
-                        else:
-                            ambiguity = True
-                    else:
-                        possibles = []
-
-                # Try edit distance with lord titles.
-                if not match and not ambiguity:
-                    match, ambiguity, possibles = match_edit_distance_df(target, speechdate, lord_titles_df,
-                                                              ('start_search', 'end_search', 'alias'), speaker_dict)
-
-                    if match: fuzzy_flag = 1
-
-                # if not match and not ambiguity:
-                #     match, ambiguity = match_edit_distance_df(target, speechdate, title_df,
-                #                                               ('start_search', 'start_search', 'alias'), speaker_dict)
-                #     if match: fuzzy_flag = 1
-
-                # Try edit distance with honorary titles.
-                # if not match and not ambiguity:
-                #     match, ambiguity = match_edit_distance_df(target, speechdate, honorary_title_df,
-                #                                               ('start_search', 'end_search', 'honorary_title'),
-                #                                               speaker_dict)
-                #     if match: fuzzy_match_indexes.append(i)
-
-                # Try edit distance with office holdings.
-                if not match and not ambiguity:
-                    office_ids = []
-                    for office in data.office_dict.values():
-                        for alias in office.aliases:
-                            if within_distance_four(alias, target, False):
-                                office_ids.append(office.id)
-
-                    if office_ids:
-                        condition = (speechdate >= holdings_df['start_search']) & \
-                                    (speechdate < holdings_df['end_search']) & \
-                                    (holdings_df['office_id'].isin(office_ids))
-                        query = holdings_df[condition]
-
-                        if len(query) == 1:
-                            match = query.iloc[0]['corresponding_id']
-                            if not numpy.isnan(match) and type(match) != str:
-                                match = speaker_dict[int(match)]
-                            else:
-                                match = None
-                                ambiguity = False
-                        elif len(query) > 1:
-                            match = None
-                            ambiguity = True
-
-                        if match: fuzzy_flag = 1
-
-                # Try edit distance with MP name permutations.
-                if not match and not ambiguity:
-                    # Remove initials. (Even if we did consider initials, it would cause more unnecessary ambiguities.)
-                    target = re.sub(r'\b[a-z]\b', '', target)
-                    # Fix multiple whitespace from previous regex.
-                    target = re.sub(r'  +', ' ', target)
-
-                    possibles = []
-                    for alias in edit_distance_dict:
-                        # if len(possibles) > 1:
-                        #     break
-                        if within_distance_two(target, alias, False):
-                            for speaker_id in edit_distance_dict[alias]:
-                                speaker = speaker_dict[speaker_id]
-                                if speaker.start_date <= speechdate <= speaker.end_date:
-                                    fuzzy_flag = 1
-                                    possibles.append(speaker)
-
-                    if len(possibles) == 1:
-                        match = possibles[0]
-                        ambiguity = False
-                    elif len(possibles) > 1:
-                        ambiguity = True
 
-                if ambiguity and possibles:
-                    match = speaker_dict.get(data.inferences.get(debate_id, None), None)
-                    if match not in possibles:
-                        match = None
-                    else:
-                        ambiguity = False
-                        possibles = []
-
-                if ambiguity and possibles:
-                    # Filters out duplicates.
-                    speaker_ids = {speaker.member_id for speaker in possibles}
-                    possibles.clear()
-                    for speaker_id in speaker_ids:
-                        speaker = speaker_dict[speaker_id]
-                        if speaker.age_at(speechdate) < 20:
-                            continue
-                        if speaker.is_in_office(speechdate):
-                            possibles.append(speaker)
-
-                    if len(possibles) == 1:
-                        ambiguity = False
-                        match = possibles[0]
-                        flag = 6
+        if ambiguity and possibles:
+            # Filters out duplicates.
+            speaker_ids = {speaker.member_id for speaker in possibles}
+            possibles.clear()
+            for speaker_id in speaker_ids:
+                speaker = speaker_dict[speaker_id]
+                if speaker.age_at(speechdate) < 20:
+                    continue
+                if speaker.is_in_office(speechdate):
+                    possibles.append(speaker)
 
-                if ambiguity:
-                    match = disambiguate(target, speechdate, row.speaker_house, row.debate_id, data.speaker_dict)
-                    if match == -1:
-                        match = None
-                    else:
-                        ambiguity = False
-                        match = speaker_dict.get(match, match)
+            if len(possibles) == 1:
+                ambiguity = False
+                match = possibles[0]
+                flag = 6
 
-                if match is not None:
-                    chunk.loc[i, 'fuzzy_matched'] = fuzzy_flag
-                    if isinstance(match, SpeakerReplacement):
-                        chunk.loc[i, OUTPUT_COLUMN] = match.id
-                    else:
-                        chunk.loc[i, OUTPUT_COLUMN] = match
-                    MATCH_CACHE[(target, speechdate)] = match
-                elif ambiguity:
-                    chunk.loc[i, 'fuzzy_matched'] = fuzzy_flag
-                    chunk.loc[i, 'ambiguous'] = 1
-
-                    possibles = [speaker.id if isinstance(speaker, SpeakerReplacement) else speaker for speaker in possibles if speaker]
-                    if not possibles:
-                        match = None
-                    else:
-                        match = '|'.join(possibles)
-                        chunk.loc[i, OUTPUT_COLUMN] = match
-                    AMBIG_CACHE[(target, speechdate)] = match
-                else:
-                    # TODO: fix this
-                    # best_guess = find_best_jaro_dist(target, alias_dict, honorary_title_df, lord_titles_df, aliases_df, speechdate)
-                    # print('Best Guess for ', target, ' : ', best_guess)
-                    chunk.loc[i, OUTPUT_COLUMN] = None
-                    MISS_CACHE.add((target, speechdate))
+        if ambiguity:
+            match = disambiguate(target, speechdate, speaker_house, debate_id, data.speaker_dict)
+            if match == -1:
+                match = None
+            else:
+                ambiguity = False
+                match = speaker_dict.get(match, match)
+
+        if match is not None:
+            suggestion = match.id if isinstance(match, SpeakerReplacement) else match
+            result = (suggestion, 0, fuzzy_flag)
+        elif ambiguity:
+            possibles = [speaker.id if isinstance(speaker, SpeakerReplacement) else speaker for speaker in possibles if speaker]
+            if possibles:
+                suggestion = '|'.join(possibles)
+            else:
+                # Nothing to list, the row keeps its preprocessed speaker name.
+                suggestion = cache_target
+            result = (suggestion, 1, fuzzy_flag)
+        else:
+            # See best_guess for the closest name.
+            result = (None, 0, 0)
+
+        if negative_cache is not None and match is None and not ambiguity and window.unbounded:
+            # Nothing on any date, every worker can skip this target from now on.
+            negative_cache.add(cache_target)
+        else:
+            RESULT_CACHE.put(cache_target, window.start, window.end, result)
+            # Results settled by the debate depend on which worker saw the date first, they are kept private so the
+            # output does not depend on scheduling.
+            if shared_cache is not None and not window.collapsed:
+                shared_cache.put(cache_target, window.start, window.end, result)
+        if persistent_cache is not None:
+            if window.collapsed:
+                persistent_cache.put_context(cache_target, window.date, context, result, sources)
+            else:
+                persistent_cache.put(cache_target, window.start, window.end, result, sources)
+
+        return result + (0, )
+
+    def best_guess(target: str, speechdate: datetime) -> Tuple[Optional[str], float, int]:
+        # The closest name valid on speechdate for a target nothing resolves, and the names blocked in to find it.
+        window = DateWindow(speechdate)
+        cached = BEST_GUESS_CACHE.get(target, window.date)
+        if cached is None:
+            blocked = best_guess_index.blocked
+            guess, score = best_guess_index.search(target, speechdate, window)
+            cached = (guess, score, best_guess_index.blocked - blocked)
+            BEST_GUESS_CACHE.put(target, window.start, window.end, cached)
+        return cached
+
+    output_columns = ['sentence_id', 'speaker', OUTPUT_COLUMN, 'ambiguous', 'fuzzy_matched', 'ignored']
+    if best_guess_index is not None:
+        output_columns += ['best_guess', 'best_guess_score']
+
+    while True:
+        waiting = time.perf_counter()
+        try:
+            entry = inq.get(block=True)
+        except Empty:
+            continue
+        else:
+            input_wait = time.perf_counter() - waiting
+            if entry is None:
+                # This is our signal that we are done here. Every other worker thread will get a similar signal.
+                for cache in (shared_cache, persistent_cache, negative_cache):
+                    if cache is not None:
+                        cache.close()
+                return
+            sequence, chunk = entry
+            started = time.perf_counter()
+            if not isinstance(chunk, pd.DataFrame):
+                # A SharedFrame or a ByteRange of the input.
+                chunk = chunk.load()
+
+            memo_hits, memo_misses = preprocess_memo.hits, preprocess_memo.misses
+            source_stats = {name: source.stats() for name, source in stat_sources.items()}
+            chunk[OUTPUT_COLUMN], distinct_speakers = preprocess_column(chunk['speaker'])
+            chunk_stats = {
+                'preprocess_rows': len(chunk),
+                'preprocess_distinct': distinct_speakers,
+                'preprocess_hits': preprocess_memo.hits - memo_hits,
+                'preprocess_misses': preprocess_memo.misses - memo_misses,
+                'input_wait_seconds': input_wait,
+            }
+
+            # Resolve each distinct key once, then broadcast the results back to every row sharing it.
+            group_ids = chunk.groupby([OUTPUT_COLUMN, 'speechdate', 'speaker_house', 'debate_id'],
+                                      sort=False, dropna=False).ngroup().to_numpy()
+            _, first_rows = numpy.unique(group_ids, return_index=True)
+
+            suggested = numpy.empty(len(first_rows), dtype=object)
+            ambiguous = numpy.zeros(len(first_rows), dtype=int)
+            fuzzy_matched = numpy.zeros(len(first_rows), dtype=int)
+            ignored = numpy.zeros(len(first_rows), dtype=int)
+            guesses = numpy.empty(len(first_rows), dtype=object)
+            guess_scores = numpy.full(len(first_rows), numpy.nan)
+            guess_seconds = 0.0
+            # Names the best guesses of this chunk may block in. A cached guess costs what its search did, so which
+            # rows get a guess only depends on the chunk, not on what this worker saw before.
+            guess_budget = best_guess_budget * len(chunk)
+            guess_spent = 0
+            guess_skipped = 0
+
+            for g, row in enumerate(chunk.iloc[first_rows].itertuples(index=False)):
+                target = getattr(row, OUTPUT_COLUMN)
+                suggested[g], ambiguous[g], fuzzy_matched[g], ignored[g] = resolve(target,
+                                                                                    row.speechdate,
+                                                                                    row.speaker_house,
+                                                                                    row.debate_id)
+                if best_guess_index is not None and suggested[g] is None and not ambiguous[g] and not ignored[g]:
+                    if guess_spent >= guess_budget:
+                        guess_skipped += 1
+                        continue
+                    guessing = time.perf_counter()
+                    guess, score, cost = best_guess(target, row.speechdate)
+                    guess_seconds += time.perf_counter() - guessing
+                    guess_spent += cost
+                    if guess is not None:
+                        guesses[g], guess_scores[g] = guess, score
+
+            chunk = chunk.assign(**{
+                OUTPUT_COLUMN: suggested[group_ids],
+                'ambiguous': ambiguous[group_ids],
+                'fuzzy_matched': fuzzy_matched[group_ids],
+                'ignored': ignored[group_ids],
+            })
+            if best_guess_index is not None:
+                chunk = chunk.assign(best_guess=guesses[group_ids], best_guess_score=guess_scores[group_ids])
+            chunk_stats['resolve_rows'] = len(chunk)
+            chunk_stats['resolve_keys'] = len(first_rows)
+            for name, source in stat_sources.items():
+                for key, value in source.stats().items():
+                    chunk_stats[f'{name}_{key}'] = value - source_stats[name][key]
 
             # outq.put((0, chunk.loc[matched_indexes, ['sentence_id', OUTPUT_COLUMN]], chunk.loc[missed_indexes, :], chunk.loc[ambiguities_indexes, :], chunk.loc[ignored_indexes, :]))
-            outq.put((0, chunk[['sentence_id', 'speaker', OUTPUT_COLUMN, 'ambiguous', 'fuzzy_matched', 'ignored']]))
+            output = chunk[output_columns]
+            chunk_stats['chunk_seconds'] = time.perf_counter() - started
+            if best_guess_index is not None:
+                chunk_stats['best_guess_seconds'] = guess_seconds
+                chunk_stats['best_guess_skipped'] = guess_skipped
+            stalled = time.perf_counter()
+            outq.put((0, SharedFrame(output) if shared_frames else output, sequence))
+            chunk_stats['output_stall_seconds'] = time.perf_counter() - stalled
+            outq.put((1, chunk_stats))
 
             hitcount = 0
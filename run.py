@@ -2,26 +2,105 @@ import pandas as pd
 import logging
 import time
 import sys
-from multiprocessing import Process, Queue, cpu_count
+from multiprocessing import Process, Queue, cpu_count, resource_tracker
 import argparse
+import shutil
+import tempfile
 from hansard import *
-from hansard.loader import DataStruct
+from hansard.checkpoint import Checkpoint, file_digest
+from hansard.cache import NegativeCache, PersistentResolutionCache, SharedIntervalCache
+from hansard.ingest import INPUT_COLUMNS, ByteRange, byte_ranges, normalize_chunk
+from hansard.loader import DataStruct, data_source_versions
+from hansard.transport import AdmissionQueue, ReorderWindow, SharedFrame, frame_nbytes
 from datetime import datetime
 import requests
 from hansard.worker import OUTPUT_COLUMN
 
 
 CPU_CORES = 2
+SHARED_CACHE_SIZE = 0
+RESOLUTION_CACHE_PATH = None
+NEGATIVE_CACHE_BITS = 0
+BEST_GUESS_CANDIDATES = 0
+BEST_GUESS_BUDGET = 0
+SHARED_FRAMES = False
+PARALLEL_READ = False
+QUEUE_CHUNKS = 0
+QUEUE_BYTES = 0
+REORDER_WINDOW = 0
+RESUME = False
+
+# Seconds between two checkpoints of the chunks written.
+CHECKPOINT_INTERVAL = 5
 
 
 def parse_config():
-    global CPU_CORES
+    global CPU_CORES, SHARED_CACHE_SIZE, RESOLUTION_CACHE_PATH, NEGATIVE_CACHE_BITS, BEST_GUESS_CANDIDATES, \
+        BEST_GUESS_BUDGET, SHARED_FRAMES, PARALLEL_READ, QUEUE_CHUNKS, QUEUE_BYTES, REORDER_WINDOW, RESUME
     parser = argparse.ArgumentParser()
     parser.add_argument('--cores', nargs=1, default=1, type=int, help='Number of cores to use.')
+    parser.add_argument('--shared-cache', action='store_true',
+                        help='Share resolutions between the worker processes through a SQLite file.')
+    parser.add_argument('--shared-cache-size', default=2**20, type=int,
+                        help='Number of resolutions kept in the shared cache before the oldest are evicted.')
+    parser.add_argument('--resolution-cache', metavar='PATH',
+                        help='SQLite file keeping resolutions from one run to the next.')
+    parser.add_argument('--negative-cache', action='store_true',
+                        help='Share the names resolving to nothing on every date between the worker processes.')
+    parser.add_argument('--negative-cache-bits', default=2**24, type=int,
+                        help='Size in bits of the Bloom filter in front of the negative cache.')
+    parser.add_argument('--best-guess', action='store_true',
+                        help='Add the closest valid name to unresolved rows (best_guess and best_guess_score columns).')
+    parser.add_argument('--best-guess-candidates', default=256, type=int,
+                        help='Number of names scored at most for each best guess.')
+    parser.add_argument('--best-guess-budget', default=32, type=float,
+                        help='Names blocked in at most by the best guesses of a chunk, per row of the chunk. The rows '
+                             'past the budget get no guess.')
+    parser.add_argument('--shared-memory', action='store_true',
+                        help='Hand chunks to and from the workers through shared memory instead of the queue pipes.')
+    parser.add_argument('--parallel-read', action='store_true',
+                        help='Let the workers read and parse their own byte ranges of the input file.')
+    parser.add_argument('--queue-chunks', default=0, type=int,
+                        help='Chunks waiting for a worker at most, two per worker by default.')
+    parser.add_argument('--queue-bytes', default=2**30, type=int,
+                        help='Bytes of chunks waiting for a worker at most.')
+    parser.add_argument('--unordered', action='store_true',
+                        help='Write chunks as soon as they are done instead of in input order.')
+    parser.add_argument('--reorder-window', default=0, type=int,
+                        help='Chunks handed out at most past the next one to write, four per worker by default.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the chunks the last run with the same input and settings wrote, and append the rest.')
     args = parser.parse_args()
     CPU_CORES = args.cores[0]
     if CPU_CORES < 0 or CPU_CORES > cpu_count():
         raise ValueError('Invalid core number specified.')
+    if args.shared_cache:
+        if args.shared_cache_size <= 0:
+            raise ValueError('Invalid shared cache size specified.')
+        SHARED_CACHE_SIZE = args.shared_cache_size
+    RESOLUTION_CACHE_PATH = args.resolution_cache
+    if args.negative_cache:
+        if args.negative_cache_bits <= 0:
+            raise ValueError('Invalid negative cache size specified.')
+        NEGATIVE_CACHE_BITS = args.negative_cache_bits
+    if args.best_guess:
+        if args.best_guess_candidates <= 0:
+            raise ValueError('Invalid best guess candidate count specified.')
+        BEST_GUESS_CANDIDATES = args.best_guess_candidates
+        if args.best_guess_budget <= 0:
+            raise ValueError('Invalid best guess budget specified.')
+        BEST_GUESS_BUDGET = args.best_guess_budget
+    SHARED_FRAMES = args.shared_memory
+    PARALLEL_READ = args.parallel_read
+    if args.queue_chunks < 0 or args.queue_bytes <= 0:
+        raise ValueError('Invalid queue bounds specified.')
+    QUEUE_CHUNKS = args.queue_chunks or 2 * max(CPU_CORES - 1, 1)
+    QUEUE_BYTES = args.queue_bytes
+    if args.reorder_window < 0:
+        raise ValueError('Invalid reorder window specified.')
+    if not args.unordered:
+        REORDER_WINDOW = args.reorder_window or 4 * max(CPU_CORES - 1, 1)
+    RESUME = args.resume
 
 
 def init_logging():
@@ -41,14 +120,17 @@ def init_logging():
     logging.debug(f'Utilizing {CPU_CORES} cores...')
 
 
-def export(output_queue, slack_secret):
+def export(output_queue, slack_secret, checkpoint, reorder_window=None):
     import time
 
-    output_fp = os.path.join(OUTPUT_DIR, 'output_.csv')
-
-    # Overwrite the file temporarily.
-    with open(output_fp, 'w+'):
-        pass
+    # Anything appended after the last checkpoint is cut off and written again. A new run saves its empty
+    # checkpoint before emptying the file, so the checkpoint never covers more than the file holds.
+    if not checkpoint.written:
+        checkpoint.save()
+    with open(checkpoint.output_path, 'a+b') as f:
+        f.truncate(checkpoint.size)
+    output = open(checkpoint.output_path, 'a')
+    saved_at = time.time()
 
     hit = 0
     ambiguities = 0
@@ -56,6 +138,33 @@ def export(output_queue, slack_secret):
     missed = 0
     i = 0
 
+    # Counters reported by the workers, summed over every chunk.
+    worker_stats = {}
+
+    # Chunks done ahead of their turn by sequence number, when writing in input order.
+    pending = {}
+    next_sequence = 0
+    while next_sequence in checkpoint.written:
+        next_sequence += 1
+    if reorder_window is not None:
+        reorder_window.advance(next_sequence)
+
+    def save_checkpoint():
+        nonlocal saved_at
+        output.flush()
+        os.fsync(output.fileno())
+        checkpoint.save()
+        saved_at = time.time()
+
+    def write(chunk_, sequence_):
+        nonlocal i
+        i += 1
+        chunk_.to_csv(output, header=output.tell()==0, index=False)
+        checkpoint.record(sequence_, output.tell())
+        if time.time() - saved_at >= CHECKPOINT_INTERVAL:
+            save_checkpoint()
+        print(f'Processed {i} chunks so far.')
+
     t0 = time.time()
 
     # TODO: multiprocess logging.
@@ -63,6 +172,13 @@ def export(output_queue, slack_secret):
     while True:
         entry = output_queue.get(block=True)
         if entry is None:
+            if pending:
+                # Only when a worker died with a chunk, the ones after it are still written.
+                print(f'Chunk {next_sequence} never came back, writing the {len(pending)} chunks after it.')
+                for sequence in sorted(pending):
+                    write(pending[sequence], sequence)
+            save_checkpoint()
+            output.close()
             print('Finished all chunks.')
             break
         else:
@@ -70,7 +186,9 @@ def export(output_queue, slack_secret):
             entry = entry[1:]
 
             if entry_type == 0:
-                chunk_ = entry[0]
+                chunk_, sequence = entry
+                if isinstance(chunk_, SharedFrame):
+                    chunk_ = chunk_.load()
 
                 chunk_ambiguities = len(chunk_[chunk_['ambiguous'] == 1])
                 chunk_ignored = len(chunk_[chunk_['ignored'] == 1])
@@ -81,14 +199,27 @@ def export(output_queue, slack_secret):
                 ignored += chunk_ignored
                 missed += chunk_missed
                 hit += chunk_hit
-                i += 1
-                with open(output_fp, 'a') as f:
-                    chunk_.to_csv(f, mode='a', header=f.tell()==0, index=False)
-                print(f'Processed {i} chunks so far.')
+
+                if reorder_window is None:
+                    write(chunk_, sequence)
+                else:
+                    pending[sequence] = chunk_
+                    while next_sequence in pending:
+                        write(pending.pop(next_sequence), next_sequence)
+                        next_sequence += 1
+                        while next_sequence in checkpoint.written:
+                            next_sequence += 1
+                    reorder_window.advance(next_sequence)
+            elif entry_type == 1:
+                for key, value in entry[0].items():
+                    worker_stats[key] = worker_stats.get(key, 0) + value
 
     from util.slackbot import Blocks, send_slack_post
 
     total = missed + ambiguities + hit - ignored
+    if not total:
+        print('No rows left to process.')
+        return
 
     hit_percent = hit/total * 100
     ambig_percent = ambiguities/total * 100
@@ -111,6 +242,74 @@ def export(output_queue, slack_secret):
     print(f'{ignored} ignored ({missed_percent:.2f}%)...')
     print(f'Total rows processed: {total}')
 
+    report_worker_stats(worker_stats)
+
+
+def input_chunks(written):
+    # (sequence number, queue entry, size in bytes) for every chunk of the input not in written, in order.
+    if PARALLEL_READ:
+        # Only record boundaries are found here, the workers read and parse the ranges.
+        for sequence, (start, end) in enumerate(byte_ranges(DATA_FILE, CHUNK_BYTES)):
+            if sequence not in written:
+                yield sequence, ByteRange(DATA_FILE, start, end), end - start
+    else:
+        for sequence, chunk in enumerate(pd.read_csv(DATA_FILE,
+                                                     sep=',',
+                                                     chunksize=CHUNK_SIZE,
+                                                     usecols=INPUT_COLUMNS)):  # type: pd.DataFrame
+            if sequence in written:
+                continue
+            chunk = normalize_chunk(chunk)
+            if SHARED_FRAMES:
+                shared = SharedFrame(chunk)
+                yield sequence, shared, shared.nbytes
+            else:
+                yield sequence, chunk, frame_nbytes(chunk)
+
+
+def report_worker_stats(worker_stats):
+    rows = worker_stats.get('preprocess_rows', 0)
+    if rows:
+        distinct = worker_stats['preprocess_distinct']
+        hits = worker_stats['preprocess_hits']
+        print(f'Preprocessing: {distinct} distinct speaker values per chunk out of {rows} rows '
+              f'({(1 - distinct / rows) * 100:.2f}% of rows reused a value from their chunk)...')
+        print(f'Preprocessing: {hits}/{distinct} distinct values found in the memo ({hits / distinct * 100:.2f}%)...')
+
+    if 'input_wait_seconds' in worker_stats:
+        print(f'Workers: {worker_stats["input_wait_seconds"]:.2f} s waiting for input, '
+              f'{worker_stats["output_stall_seconds"]:.2f} s waiting for room on the export queue...')
+
+    for name in ('edit_distance', 'fuzzy_office', 'fuzzy_lord_titles'):
+        scanned = worker_stats.get(f'{name}_scanned', 0)
+        if scanned:
+            compared = worker_stats[f'{name}_compared']
+            print(f'{name}: {worker_stats[f"{name}_searches"]} searches compared {compared}/{scanned} aliases '
+                  f'({(1 - compared / scanned) * 100:.2f}% pruned)...')
+
+    for name in ('result_cache', 'shared_cache', 'persistent_cache', 'negative_cache', 'best_guess_cache'):
+        lookups = worker_stats.get(f'{name}_hits', 0) + worker_stats.get(f'{name}_misses', 0)
+        if lookups:
+            hits = worker_stats[f'{name}_hits']
+            print(f'{name}: {hits}/{lookups} lookups hit ({hits / lookups * 100:.2f}%)...')
+    if 'result_cache_bytes' in worker_stats:
+        print(f'result_cache: {worker_stats["result_cache_evictions"]} evicted, '
+              f'{worker_stats["result_cache_bytes"] / 2**20:.2f} MiB held by all workers at the end...')
+    if 'shared_cache_inserts' in worker_stats:
+        print(f'shared_cache: {worker_stats["shared_cache_inserts"]} inserted, '
+              f'{worker_stats["shared_cache_evictions"]} evicted...')
+    if 'negative_cache_inserts' in worker_stats:
+        print(f'negative_cache: {worker_stats["negative_cache_inserts"]} inserted, '
+              f'{worker_stats["negative_cache_false_positives"]} false positives confirmed away...')
+    searches = worker_stats.get('best_guess_searches', 0)
+    if searches:
+        print(f'best_guess: {worker_stats["best_guess_guesses"]}/{searches} searches found a guess, '
+              f'{worker_stats["best_guess_candidates"] / searches:.1f} names valid and '
+              f'{worker_stats["best_guess_scored"] / searches:.1f} scored per search...')
+    if 'best_guess_seconds' in worker_stats:
+        print(f'best_guess: {worker_stats["best_guess_seconds"] / worker_stats["chunk_seconds"] * 100:.1f}% of worker '
+              f'time, {worker_stats["best_guess_skipped"]} lookups over budget got no guess...')
+
 
 if __name__ == '__main__':
     parse_config()
@@ -118,16 +317,62 @@ if __name__ == '__main__':
 
     data = DataStruct()
     data.load()
+    if BEST_GUESS_CANDIDATES:
+        data.load_best_guess_index(BEST_GUESS_CANDIDATES)
 
-    from hansard.worker import worker_function
+    from hansard.worker import rules_version, worker_function
 
-    inq = Queue()
-    outq = Queue()
+    # Chunks are only read as fast as the workers take them, and finished chunks as fast as they are exported.
+    inq = AdmissionQueue(QUEUE_CHUNKS, QUEUE_BYTES)
+    outq = Queue(maxsize=2 * QUEUE_CHUNKS)
 
     logging.info('Loading processes...')
 
+    # Files of the caches shared between workers, removed at the end of the run.
+    shared_cache_dir = tempfile.mkdtemp(prefix='hansard_cache_') if SHARED_CACHE_SIZE or NEGATIVE_CACHE_BITS else None
+
+    shared_cache = None
+    if SHARED_CACHE_SIZE:
+        shared_cache = SharedIntervalCache(os.path.join(shared_cache_dir, 'resolutions.sqlite'), SHARED_CACHE_SIZE)
+        logging.info(f'Sharing up to {SHARED_CACHE_SIZE} resolutions between workers...')
+
+    negative_cache = None
+    if NEGATIVE_CACHE_BITS:
+        negative_cache = NegativeCache(os.path.join(shared_cache_dir, 'negatives.sqlite'), NEGATIVE_CACHE_BITS)
+        logging.info(f'Sharing names resolving to nothing through a {NEGATIVE_CACHE_BITS} bit filter...')
+
+    persistent_cache = None
+    if RESOLUTION_CACHE_PATH:
+        persistent_cache = PersistentResolutionCache(RESOLUTION_CACHE_PATH)
+        changed = persistent_cache.invalidate({**data_source_versions(), 'rules': rules_version()})
+        # The workers open their own connections.
+        persistent_cache.close()
+        logging.info(f'Reusing resolutions from {RESOLUTION_CACHE_PATH}, '
+                     f'dropped the ones depending on: {", ".join(changed) or "nothing"}...')
+
+    if SHARED_FRAMES:
+        # Started before the workers so every process shares it: segments are created by one process and
+        # unlinked by another, and whatever is left is unlinked when the run ends.
+        resource_tracker.ensure_running()
+        logging.info('Handing chunks over through shared memory...')
+
+    # Sequence numbers and output rows depend on all of these, a run only resumes from a checkpoint with the same.
+    checkpoint = Checkpoint(os.path.join(OUTPUT_DIR, 'output_.csv'), {
+        'input': file_digest(DATA_FILE),
+        'chunks': f'{CHUNK_BYTES} bytes' if PARALLEL_READ else f'{CHUNK_SIZE} rows',
+        'best_guess': BEST_GUESS_CANDIDATES and f'{BEST_GUESS_CANDIDATES} candidates, {BEST_GUESS_BUDGET} per row',
+        'rules': rules_version(),
+        **data_source_versions(),
+    })
+    if RESUME:
+        if checkpoint.resume():
+            logging.info(f'Resuming, skipping the {len(checkpoint.written)} chunks already written...')
+        else:
+            logging.info(f'Nothing to resume from {checkpoint.path}, starting over...')
+
     # Reserve a core for the export process.
-    process_args = (inq, outq, data)
+    process_args = (inq, outq, data, shared_cache, persistent_cache, negative_cache, SHARED_FRAMES,
+                    BEST_GUESS_BUDGET)
     processes = [Process(target=worker_function, args=process_args) for _ in range(CPU_CORES - 1)]
 
     for p in processes:
@@ -141,28 +386,47 @@ if __name__ == '__main__':
     else:
         print('export: Using slack updates.')
 
-    export_process = Process(target=export, args=(outq, SLACK_SECRET))
+    # Workers only get chunks close enough to the next one to write, so the exporter buffers a bounded number of them.
+    reorder_window = ReorderWindow(REORDER_WINDOW) if REORDER_WINDOW else None
+
+    export_process = Process(target=export, args=(outq, SLACK_SECRET, checkpoint, reorder_window))
     export_process.start()
 
     num_chunks = 0
 
-    for chunk in pd.read_csv(DATA_FILE,
-                             sep=',',
-                             chunksize=CHUNK_SIZE,
-                             usecols=['sentence_id', 'speechdate', 'speaker', 'debate_id', 'speaker_house']):  # type: pd.DataFrame
-        chunk['speaker_house'] = chunk['speaker_house'].str.replace('[^A-Za-z ]', '', regex=True)
-        is_commons = chunk['speaker_house'] == 'HOUSE OF COMMONS'
-        is_lords = chunk['speaker_house'] == 'HOUSE OF LORDS'
-        chunk['speaker_house'] = is_commons + (is_lords * 2)
-        chunk['speechdate'] = pd.to_datetime(chunk['speechdate'], format=DATE_FORMAT)
-        inq.put(chunk)
+    # A dead worker never returns the chunk it held: the exporter stops waiting for it once any worker died, the
+    # input queue stops waiting for room once every worker did.
+    def any_worker_died():
+        return any(process.exitcode is not None for process in processes)
+
+    def all_workers_died():
+        return all(process.exitcode is not None for process in processes)
+
+    # Chunks are numbered in input order.
+    for sequence, entry, nbytes in input_chunks(checkpoint.written):
+        if reorder_window is not None:
+            reorder_window.admit(sequence, release_if=any_worker_died)
+        inq.put((sequence, entry), nbytes, release_if=all_workers_died)
         num_chunks += 1
 
     logging.info(f'Added {num_chunks} chunks to the queue.')
+    queue_stats = inq.stats()
+    if queue_stats['puts']:
+        logging.info(f'Input queue: {queue_stats["stalls"]}/{queue_stats["puts"]} chunks waited for room, '
+                     f'{queue_stats["stall_seconds"]:.2f} s in all. {queue_stats["depth_total"] / queue_stats["puts"]:.1f} '
+                     f'chunks were waiting on average, at most {queue_stats["depth_max"]} '
+                     f'({queue_stats["bytes_max"] / 2**20:.1f} MiB, limits {QUEUE_CHUNKS} chunks and '
+                     f'{QUEUE_BYTES / 2**20:.1f} MiB)...')
+    if reorder_window is not None:
+        logging.info(f'Reorder window: {reorder_window.stalls} chunks waited for the exporter to catch up, '
+                     f'{reorder_window.stall_seconds:.2f} s in all (window of {REORDER_WINDOW} chunks)...')
+        if reorder_window.released:
+            logging.warning('A worker died, the chunks after the one it held were handed out without waiting for '
+                            'the exporter...')
 
     for _ in range(len(processes)):
         # Signals to process that no more entries will be added.
-        inq.put(None)
+        inq.put(None, release_if=all_workers_died)
 
     logging.info('Waiting on worker processes...')
     for process in processes:
@@ -178,4 +442,10 @@ if __name__ == '__main__':
     for process in processes:
         process.terminate()
 
+    if negative_cache is not None:
+        negative_cache.filter.close()
+        negative_cache.filter.unlink()
+    if shared_cache_dir is not None:
+        shutil.rmtree(shared_cache_dir, ignore_errors=True)
+
     logging.info('Exiting...')
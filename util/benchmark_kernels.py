@@ -0,0 +1,99 @@
+import random
+import time
+from typing import Callable, List
+
+from hansard.index import EditDistanceIndex
+from hansard.loader import DataStruct
+from util.edit_distance import PackedAliases, within_distance_batch, within_distance_two
+from util.jaro_distance import JaroScorer, jaro_distance
+
+# Run from the repository root: python -m util.benchmark_kernels
+
+SEED = 0
+TARGETS = 200
+
+
+def misspell(alias: str, rng: random.Random) -> str:
+    chars = list(alias)
+    for _ in range(rng.randint(0, 2)):
+        if not chars:
+            break
+        i = rng.randrange(len(chars))
+        edit = rng.randrange(3)
+        if edit == 0:
+            del chars[i]
+        elif edit == 1:
+            chars[i] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+        else:
+            chars.insert(i, rng.choice('abcdefghijklmnopqrstuvwxyz'))
+    return ''.join(chars)
+
+
+def timed(name: str, func: Callable[[str], List[int]], targets: List[str], baseline: float = 0) -> float:
+    start = time.perf_counter()
+    for target in targets:
+        func(target)
+    elapsed = (time.perf_counter() - start) / len(targets)
+    speedup = f' ({baseline / elapsed:.1f}x)' if baseline else ''
+    print(f'  {name:<24} {elapsed * 1e6:10.1f} us/target{speedup}')
+    return elapsed
+
+
+def benchmark_edit_distance(index: EditDistanceIndex, targets: List[str]):
+    aliases = index.aliases
+    packed = index.packed
+
+    def pairwise(target):
+        return [i for i, alias in enumerate(aliases) if within_distance_two(target, alias, False)]
+
+    for target in targets:
+        assert pairwise(target) == within_distance_batch(target, packed, 2)
+
+    print(f'within distance two, {len(aliases)} aliases:')
+    baseline = timed('pairwise', pairwise, targets)
+    timed('batch', lambda target: within_distance_batch(target, packed, 2), targets, baseline)
+    timed('batch (prange)', lambda target: within_distance_batch(target, packed, 2, parallel=True), targets, baseline)
+
+    # One alias outside Latin-1 stores every alias with 2 bytes per character.
+    wide = PackedAliases(aliases + ['mr o’connell'])
+    timed('batch (UCS-2 aliases)', lambda target: within_distance_batch(target, wide, 2), targets, baseline)
+
+    def pairwise_candidates(target):
+        return [i for i in index.candidates(target) if within_distance_two(target, aliases[i], False)]
+
+    print('  after the n-gram filter of EditDistanceIndex:')
+    baseline = timed('pairwise', pairwise_candidates, targets)
+    timed('batch', index.positions, targets, baseline)
+
+
+def benchmark_jaro(index: EditDistanceIndex, targets: List[str]):
+    aliases = index.aliases
+    scorer = JaroScorer(index.packed)
+
+    def pairwise(target):
+        scores = [(-jaro_distance(target, alias), i) for i, alias in enumerate(aliases)]
+        return [(i, -score) for score, i in sorted(scores) if -score >= 0.8][:5]
+
+    for target in targets:
+        assert pairwise(target) == scorer.top_k(target, 5, 0.8)
+
+    print(f'jaro top 5 above 0.8, {len(aliases)} aliases:')
+    baseline = timed('pairwise', pairwise, targets)
+    timed('JaroScorer.top_k', lambda target: scorer.top_k(target, 5, 0.8), targets, baseline)
+    print(f'  {scorer.scored / scorer.searches:.0f} aliases scored per search, the rest ruled out by length')
+
+
+def main():
+    data = DataStruct()
+    data.load()
+
+    index = data.edit_distance_index
+    rng = random.Random(SEED)
+    targets = [misspell(alias, rng) for alias in rng.sample(index.aliases, TARGETS)]
+
+    benchmark_edit_distance(index, targets)
+    benchmark_jaro(index, targets)
+
+
+if __name__ == '__main__':
+    main()
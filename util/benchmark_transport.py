@@ -0,0 +1,85 @@
+import argparse
+import time
+from multiprocessing import Process, Queue, resource_tracker
+
+import numpy
+import pandas as pd
+
+from hansard import CHUNK_SIZE, DATA_FILE, DATE_FORMAT
+from hansard.transport import SharedFrame
+from hansard.worker import OUTPUT_COLUMN
+
+# Run from the repository root: python -m util.benchmark_transport --workers 15
+#
+# Chunks go from the main process to the workers and from the workers to an export process, as in run.py, but the
+# workers only add the output columns. The main process time is the time spent handing chunks over, its feeder
+# thread included.
+
+CHUNKS = 64
+
+
+def read_chunk() -> pd.DataFrame:
+    chunk = pd.read_csv(DATA_FILE, nrows=CHUNK_SIZE,
+                        usecols=['sentence_id', 'speechdate', 'speaker', 'debate_id', 'speaker_house'])
+    chunk = chunk.iloc[numpy.arange(CHUNK_SIZE) % len(chunk)].reset_index(drop=True)
+    # As run.py hands them to the workers.
+    house = chunk['speaker_house'].str.replace('[^A-Za-z ]', '', regex=True)
+    chunk['speaker_house'] = (house == 'HOUSE OF COMMONS') + (house == 'HOUSE OF LORDS') * 2
+    chunk['speechdate'] = pd.to_datetime(chunk['speechdate'], format=DATE_FORMAT)
+    return chunk
+
+
+def worker(inq: Queue, outq: Queue, shared: bool):
+    while True:
+        chunk = inq.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, SharedFrame):
+            chunk = chunk.load()
+        output = chunk.assign(**{OUTPUT_COLUMN: chunk['speaker'], 'ambiguous': 0, 'fuzzy_matched': 0, 'ignored': 0})
+        output = output[['sentence_id', 'speaker', OUTPUT_COLUMN, 'ambiguous', 'fuzzy_matched', 'ignored']]
+        outq.put((0, SharedFrame(output) if shared else output))
+
+
+def export(outq: Queue, chunks: int):
+    for _ in range(chunks):
+        chunk = outq.get()[1]
+        if isinstance(chunk, SharedFrame):
+            chunk.load()
+
+
+def run(chunk: pd.DataFrame, workers: int, shared: bool):
+    inq, outq = Queue(), Queue()
+    processes = [Process(target=worker, args=(inq, outq, shared)) for _ in range(workers)]
+    exporter = Process(target=export, args=(outq, CHUNKS))
+    for process in processes + [exporter]:
+        process.start()
+
+    start, cpu = time.perf_counter(), time.process_time()
+    for _ in range(CHUNKS):
+        inq.put(SharedFrame(chunk) if shared else chunk)
+    for _ in processes:
+        inq.put(None)
+    exporter.join()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+
+    for process in processes:
+        process.join()
+    name = 'shared memory' if shared else 'pickled'
+    print(f'  {name:<16} {CHUNKS / elapsed:8.1f} chunks/s, {cpu / CHUNKS * 1e3:8.2f} ms of main process per chunk')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', default=15, type=int)
+    args = parser.parse_args()
+
+    resource_tracker.ensure_running()
+    chunk = read_chunk()
+    print(f'{CHUNKS} chunks of {len(chunk)} rows through {args.workers} workers:')
+    for shared in (False, True):
+        run(chunk, args.workers, shared)
+
+
+if __name__ == '__main__':
+    main()
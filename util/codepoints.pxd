@@ -0,0 +1,34 @@
+from cpython.unicode cimport PyUnicode_DATA, PyUnicode_GET_LENGTH, PyUnicode_KIND, Py_UCS1, Py_UCS2
+
+
+# A str read in place: `length` code points of `kind` bytes each (1, 2 or 4) at `data`.
+cdef struct Text:
+    const void* data
+    Py_ssize_t length
+    int kind
+
+
+cdef inline Text text_of(str value):
+    if value is None:
+        raise TypeError('expected str, got None')
+    cdef Text text
+    text.data = PyUnicode_DATA(value)
+    text.length = PyUnicode_GET_LENGTH(value)
+    text.kind = PyUnicode_KIND(value)
+    return text
+
+
+cdef inline Text slice_of(Text text, Py_ssize_t start, Py_ssize_t end) noexcept nogil:
+    cdef Text part
+    part.data = (<const char*> text.data) + start * text.kind
+    part.length = end - start
+    part.kind = text.kind
+    return part
+
+
+cdef inline Py_UCS4 read(Text text, Py_ssize_t i) noexcept nogil:
+    if text.kind == 1:
+        return (<const Py_UCS1*> text.data)[i]
+    if text.kind == 2:
+        return (<const Py_UCS2*> text.data)[i]
+    return (<const Py_UCS4*> text.data)[i]
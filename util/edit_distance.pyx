@@ -1,60 +1,202 @@
-from libc.stdlib cimport abs
-
-
-
-cdef bint _is_edit_distant_n(const char* incorrect,const char* correct, const int n, const bint allow_equal):
-    cdef int len_i = len(incorrect)
-    cdef int len_c = len(correct)
-    
-    if abs(len_i - len_c) > n:
-        return False
-    
-    cdef int j = 0
-    cdef int i = 0
-    cdef int count = 0
-    
-    while i < len_i and j < len_c:
-        if incorrect[i] == correct[j]:
-            i += 1
-            j += 1
-        else:
-            # characters don't match
-            if count >= n:
-                # Too many edits.
-                return False
-
-            if len_i == len_c:
-                # substitution
-                i += 1
-                j += 1
-            else:
-                # Increment if one string is longer than the other
-                i += len_i > len_c  # (Insertion)
-                j += len_c > len_i  # (Deletion)
-
-            count += 1
-
-    # Excess trailing character(s)
-    if i < len_i or j < len_c:
-        count += abs(len_i - len_c)
-
-    return (allow_equal and not count) or (count and count <= n)
-
-
-cdef extern from "Python.h":
-    const char* PyUnicode_AsUTF8(object unicode)
-
-cpdef is_distance_one(object incorrect,object correct):
-    cdef const char* a = PyUnicode_AsUTF8(incorrect)
-    cdef const char* b = PyUnicode_AsUTF8(correct)
-    return _is_edit_distant_n(a, b, 1, 0)
-
-cpdef within_distance_two(object incorrect,object correct, const bint allow_equal):
-    cdef const char* a = PyUnicode_AsUTF8(incorrect)
-    cdef const char* b = PyUnicode_AsUTF8(correct)
-    return _is_edit_distant_n(a, b, 2, allow_equal)
-
-cpdef within_distance_four(object incorrect,object correct, const bint allow_equal):
-    cdef const char* a = PyUnicode_AsUTF8(incorrect)
-    cdef const char* b = PyUnicode_AsUTF8(correct)
-    return _is_edit_distant_n(a, b, 4, allow_equal)
+# distutils: extra_compile_args = -fopenmp
+# distutils: extra_link_args = -fopenmp
+
+from array import array
+
+cimport cython
+from cython.parallel import prange
+from libc.stdlib cimport abs
+
+from cpython.unicode cimport Py_UCS1, Py_UCS2
+
+from util.codepoints cimport Text, text_of
+
+
+ctypedef fused char_i:
+    Py_UCS1
+    Py_UCS2
+    Py_UCS4
+
+ctypedef fused char_c:
+    Py_UCS1
+    Py_UCS2
+    Py_UCS4
+
+
+cdef inline bint _edit_distant_chars(const char_i* incorrect, const int len_i, const char_c* correct,
+                                     const int len_c, const int n, const bint allow_equal) noexcept nogil:
+    if abs(len_i - len_c) > n:
+        return False
+    
+    cdef int j = 0
+    cdef int i = 0
+    cdef int count = 0
+    
+    while i < len_i and j < len_c:
+        if incorrect[i] == correct[j]:
+            i += 1
+            j += 1
+        else:
+            # characters don't match
+            if count >= n:
+                # Too many edits.
+                return False
+
+            if len_i == len_c:
+                # substitution
+                i += 1
+                j += 1
+            else:
+                # Increment if one string is longer than the other
+                i += len_i > len_c  # (Insertion)
+                j += len_c > len_i  # (Deletion)
+
+            count += 1
+
+    # Excess trailing character(s)
+    if i < len_i or j < len_c:
+        count += abs(len_i - len_c)
+
+    return (allow_equal and not count) or (count and count <= n)
+
+
+cdef bint _edit_distant_text(const char_i* incorrect, const int len_i, Text correct, const int n,
+                             const bint allow_equal) noexcept nogil:
+    if correct.kind == 1:
+        return _edit_distant_chars(incorrect, len_i, <const Py_UCS1*> correct.data, <int> correct.length, n, allow_equal)
+    if correct.kind == 2:
+        return _edit_distant_chars(incorrect, len_i, <const Py_UCS2*> correct.data, <int> correct.length, n, allow_equal)
+    return _edit_distant_chars(incorrect, len_i, <const Py_UCS4*> correct.data, <int> correct.length, n, allow_equal)
+
+
+cdef bint _is_edit_distant_n(Text incorrect, Text correct, const int n, const bint allow_equal) noexcept nogil:
+    # The character loop is compiled for every pair of kinds.
+    if incorrect.kind == 1:
+        return _edit_distant_text(<const Py_UCS1*> incorrect.data, <int> incorrect.length, correct, n, allow_equal)
+    if incorrect.kind == 2:
+        return _edit_distant_text(<const Py_UCS2*> incorrect.data, <int> incorrect.length, correct, n, allow_equal)
+    return _edit_distant_text(<const Py_UCS4*> incorrect.data, <int> incorrect.length, correct, n, allow_equal)
+
+
+cpdef is_distance_one(str incorrect, str correct):
+    return _is_edit_distant_n(text_of(incorrect), text_of(correct), 1, 0)
+
+cpdef within_distance_two(str incorrect, str correct, const bint allow_equal):
+    return _is_edit_distant_n(text_of(incorrect), text_of(correct), 2, allow_equal)
+
+cpdef within_distance_four(str incorrect, str correct, const bint allow_equal):
+    return _is_edit_distant_n(text_of(incorrect), text_of(correct), 4, allow_equal)
+
+
+cdef class PackedAliases:
+    """
+    Aliases stored back to back in one str: alias i is the code points offsets[i] up to offsets[i + 1] of `text`.
+    """
+    cdef readonly str text
+    cdef readonly object offsets
+    cdef Text _text
+
+    def __init__(self, aliases):
+        offsets = array('q', [0])
+        total = 0
+        for alias in aliases:
+            total += len(alias)
+            offsets.append(total)
+        self.text = ''.join(aliases)
+        self.offsets = offsets
+        self._text = text_of(self.text)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __reduce__(self):
+        offsets = self.offsets
+        return PackedAliases, ([self.text[offsets[i]:offsets[i + 1]] for i in range(len(self))], )
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _batch_chars(const char_i* target, const int len_t, const char_c* text, const long long[::1] offsets,
+                       const long long[::1] candidates, const bint every, const int n, const bint allow_equal,
+                       const bint parallel, unsigned char[::1] accepted) noexcept nogil:
+    cdef Py_ssize_t k
+    cdef long long p
+    if parallel:
+        for k in prange(accepted.shape[0], schedule='static'):
+            p = k if every else candidates[k]
+            accepted[k] = _edit_distant_chars(target, len_t, text + offsets[p], <int>(offsets[p + 1] - offsets[p]),
+                                              n, allow_equal)
+    else:
+        for k in range(accepted.shape[0]):
+            p = k if every else candidates[k]
+            accepted[k] = _edit_distant_chars(target, len_t, text + offsets[p], <int>(offsets[p + 1] - offsets[p]),
+                                              n, allow_equal)
+
+
+cdef void _batch_text(const char_i* target, const int len_t, Text text, const long long[::1] offsets,
+                      const long long[::1] candidates, const bint every, const int n, const bint allow_equal,
+                      const bint parallel, unsigned char[::1] accepted) noexcept:
+    if text.kind == 1:
+        with nogil:
+            _batch_chars(target, len_t, <const Py_UCS1*> text.data, offsets, candidates, every, n, allow_equal,
+                         parallel, accepted)
+    elif text.kind == 2:
+        with nogil:
+            _batch_chars(target, len_t, <const Py_UCS2*> text.data, offsets, candidates, every, n, allow_equal,
+                         parallel, accepted)
+    else:
+        with nogil:
+            _batch_chars(target, len_t, <const Py_UCS4*> text.data, offsets, candidates, every, n, allow_equal,
+                         parallel, accepted)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def within_distance_batch(str target not None, PackedAliases aliases not None, const int n,
+                          const bint allow_equal=False, positions=None, const bint parallel=False):
+    """
+    Positions of the aliases within n edits of target, as the pairwise functions decide. Only `positions` are
+    compared when given, and they are returned in the order given.
+    """
+    cdef Text t = text_of(target)
+    cdef Text text = aliases._text
+    cdef const long long[::1] offsets = aliases.offsets
+    cdef Py_ssize_t size = len(aliases)
+
+    cdef const long long[::1] candidates
+    cdef bint every = positions is None
+    cdef Py_ssize_t count = size
+    if not every:
+        if isinstance(positions, (list, tuple)):
+            candidates = array('q', positions)
+        else:
+            # Any int64 buffer, e.g. a numpy array.
+            candidates = positions
+        count = candidates.shape[0]
+
+    cdef Py_ssize_t k
+    cdef long long p
+    if not every:
+        for k in range(count):
+            if not 0 <= candidates[k] < size:
+                raise IndexError(f'alias position {candidates[k]} out of range')
+
+    cdef unsigned char[::1] accepted = bytearray(count)
+    if every:
+        # Not read.
+        candidates = offsets
+
+    # The loop is compiled for every pair of kinds, so the kinds are only looked at once.
+    if t.kind == 1:
+        _batch_text(<const Py_UCS1*> t.data, <int> t.length, text, offsets, candidates, every, n, allow_equal,
+                    parallel, accepted)
+    elif t.kind == 2:
+        _batch_text(<const Py_UCS2*> t.data, <int> t.length, text, offsets, candidates, every, n, allow_equal,
+                    parallel, accepted)
+    else:
+        _batch_text(<const Py_UCS4*> t.data, <int> t.length, text, offsets, candidates, every, n, allow_equal,
+                    parallel, accepted)
+
+    if every:
+        return [k for k in range(count) if accepted[k]]
+    return [candidates[k] for k in range(count) if accepted[k]]
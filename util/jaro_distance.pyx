@@ -1,73 +1,282 @@
-
-from libc.math cimport floor
-from libc.stdlib cimport malloc, free
-
-
-cdef double _jaro_distance(const char* a,const char* b):
-    cdef int len_a = len(a)
-    cdef int len_b = len(b)
-    
-    cdef int max_dist = <int>(floor(max(len_a, len_b) / 2) - 1)
-    
-    cdef int match = 0
-    
-    cdef int *hash_a = <int *> malloc(len_a * sizeof(int))
-    cdef int *hash_b = <int *> malloc(len_b * sizeof(int))
-    
-    if not hash_a or not hash_b:
-        raise MemoryError()
-    
-    for i in range(len_a):
-        hash_a[i] = 0
-    for i in range(len_b):
-        hash_b[i] = 0
-    
-    for i in range(len_a):
-        for j in range(max(0, i - max_dist), min(len_b, i + max_dist + 1)):
-            # If there is a match
-            if a[i] == b[j] and hash_b[j] == 0:
-                hash_a[i] = 1
-                hash_b[j] = 1
-                match += 1
-                break
-    
-    # If there is no match
-    if match == 0:
-        free(hash_a)
-        free(hash_b)
-        return 0.0
-    
-    cdef int t = 0
-    cdef int point = 0
-    
-    # Count number of occurrences
-    # where two characters match but
-    # there is a third matched character
-    # in between the indices
-    for i in range(len_a):
-        if hash_a[i]:
-            # Find the next matched character
-            # in second
-            while hash_b[point] == 0:
-                point += 1
-  
-            if a[i] != b[point]:
-                t += 1
-            point += 1
-
-    t = t//2
-    
-    free(hash_a)
-    free(hash_b)
-  
-    # Return the Jaro Similarity
-    return ((match / len_a) + (match / len_b) + ((match - t) / match)) / 3.0
-
-    
-cdef extern from "Python.h":
-    const char* PyUnicode_AsUTF8(object unicode)
-    
-cpdef jaro_distance(object str_a,object str_b):
-    cdef const char* a = PyUnicode_AsUTF8(str_a)
-    cdef const char* b = PyUnicode_AsUTF8(str_b)
-    return _jaro_distance(a, b)
+from array import array
+
+cimport cython
+from libc.math cimport floor
+from libc.stdlib cimport free, realloc
+from libc.string cimport memset
+
+from cpython.unicode cimport Py_UCS1, Py_UCS2
+
+from util.codepoints cimport Text, read, slice_of, text_of
+
+
+ctypedef fused char_a:
+    Py_UCS1
+    Py_UCS2
+    Py_UCS4
+
+ctypedef fused char_b:
+    Py_UCS1
+    Py_UCS2
+    Py_UCS4
+
+
+cdef double _jaro_chars(const char_a* a, const int len_a, const char_b* b, const int len_b,
+                        unsigned char* hash_a, unsigned char* hash_b) noexcept nogil:
+    # hash_a and hash_b are scratch space for at least len_a and len_b flags.
+    cdef int max_dist = <int>(floor(max(len_a, len_b) / 2.0) - 1)
+
+    cdef int match = 0
+    cdef int i, j
+
+    memset(hash_a, 0, len_a)
+    memset(hash_b, 0, len_b)
+
+    for i in range(len_a):
+        for j in range(max(0, i - max_dist), min(len_b, i + max_dist + 1)):
+            # If there is a match
+            if a[i] == b[j] and hash_b[j] == 0:
+                hash_a[i] = 1
+                hash_b[j] = 1
+                match += 1
+                break
+
+    # If there is no match
+    if match == 0:
+        return 0.0
+
+    cdef int t = 0
+    cdef int point = 0
+
+    # Count number of occurrences
+    # where two characters match but
+    # there is a third matched character
+    # in between the indices
+    for i in range(len_a):
+        if hash_a[i]:
+            # Find the next matched character
+            # in second
+            while hash_b[point] == 0:
+                point += 1
+
+            if a[i] != b[point]:
+                t += 1
+            point += 1
+
+    t = t//2
+
+    # Return the Jaro Similarity
+    return (((<double>match) / len_a) + ((<double>match) / len_b) + ((<double>(match - t)) / match)) / 3.0
+
+
+cdef double _jaro_text(const char_a* a, const int len_a, Text b, unsigned char* hash_a,
+                       unsigned char* hash_b) noexcept nogil:
+    if b.kind == 1:
+        return _jaro_chars(a, len_a, <const Py_UCS1*> b.data, <int> b.length, hash_a, hash_b)
+    if b.kind == 2:
+        return _jaro_chars(a, len_a, <const Py_UCS2*> b.data, <int> b.length, hash_a, hash_b)
+    return _jaro_chars(a, len_a, <const Py_UCS4*> b.data, <int> b.length, hash_a, hash_b)
+
+
+cdef double _jaro_distance(Text a, Text b, unsigned char* hash_a, unsigned char* hash_b) noexcept nogil:
+    # The character loops are compiled for every pair of kinds.
+    if a.kind == 1:
+        return _jaro_text(<const Py_UCS1*> a.data, <int> a.length, b, hash_a, hash_b)
+    if a.kind == 2:
+        return _jaro_text(<const Py_UCS2*> a.data, <int> a.length, b, hash_a, hash_b)
+    return _jaro_text(<const Py_UCS4*> a.data, <int> a.length, b, hash_a, hash_b)
+
+
+cdef double _jaro_bound(const int len_a, const int len_b) noexcept nogil:
+    # Largest similarity two strings of these lengths can have: every character of the shorter one matched, in order.
+    cdef int match = min(len_a, len_b)
+    if match == 0:
+        return 0.0
+    return (((<double>match) / len_a) + ((<double>match) / len_b) + 1.0) / 3.0
+
+
+cdef double _winkler(double jaro, Text a, Text b, const double prefix_scale) noexcept nogil:
+    cdef int prefix = 0
+    while prefix < 4 and prefix < a.length and prefix < b.length and read(a, prefix) == read(b, prefix):
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1.0 - jaro)
+
+
+cdef class _Scratch:
+    # Flag buffers reused from one comparison to the next, grown when a longer string comes along.
+    cdef unsigned char* hash_a
+    cdef unsigned char* hash_b
+    cdef Py_ssize_t size
+
+    def __dealloc__(self):
+        free(self.hash_a)
+        free(self.hash_b)
+
+    cdef int reserve(self, Py_ssize_t size) except -1:
+        if size <= self.size:
+            return 0
+        cdef unsigned char* hash_a = <unsigned char*> realloc(self.hash_a, size)
+        if not hash_a:
+            raise MemoryError()
+        self.hash_a = hash_a
+        cdef unsigned char* hash_b = <unsigned char*> realloc(self.hash_b, size)
+        if not hash_b:
+            raise MemoryError()
+        self.hash_b = hash_b
+        self.size = size
+        return 0
+
+
+cdef _Scratch _pairwise_scratch = _Scratch()
+
+
+cpdef jaro_distance(str str_a, str str_b):
+    cdef Text a = text_of(str_a)
+    cdef Text b = text_of(str_b)
+    _pairwise_scratch.reserve(max(a.length, b.length, 1))
+    return _jaro_distance(a, b, _pairwise_scratch.hash_a, _pairwise_scratch.hash_b)
+
+
+cpdef jaro_winkler_distance(str str_a, str str_b, double prefix_scale=0.1):
+    cdef Text a = text_of(str_a)
+    cdef Text b = text_of(str_b)
+    _pairwise_scratch.reserve(max(a.length, b.length, 1))
+    cdef double jaro = _jaro_distance(a, b, _pairwise_scratch.hash_a, _pairwise_scratch.hash_b)
+    return _winkler(jaro, a, b, prefix_scale)
+
+
+cdef class JaroScorer:
+    """
+    Scores one target against a packed set of aliases (anything with the `text` and `offsets` of
+    util.edit_distance.PackedAliases) with the same arithmetic as jaro_distance / jaro_winkler_distance.
+
+    `top_k` returns up to k (position, score) pairs scoring at least `threshold`, best first and by position on ties.
+    Aliases whose length alone keeps them under the threshold, or under the k-th best score so far, are not scored.
+    The flag buffers and the top-k arrays are kept between calls, so a search allocates nothing but its result.
+    """
+    cdef readonly object aliases
+    cdef str _packed
+    cdef Text _text
+    cdef const long long[::1] _offsets
+    cdef Py_ssize_t _size
+    cdef _Scratch _scratch
+    cdef Py_ssize_t* _best_positions
+    cdef double* _best_scores
+    cdef Py_ssize_t _capacity
+
+    # Number of searches, and aliases scored by them.
+    cdef readonly long long searches
+    cdef readonly long long scored
+
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self._packed = aliases.text
+        self._text = text_of(self._packed)
+        self._offsets = aliases.offsets
+        self._size = self._offsets.shape[0] - 1
+        self._scratch = _Scratch()
+
+        cdef Py_ssize_t longest = 1
+        cdef Py_ssize_t p
+        for p in range(self._size):
+            longest = max(longest, self._offsets[p + 1] - self._offsets[p])
+        self._scratch.reserve(longest)
+
+    def __reduce__(self):
+        return JaroScorer, (self.aliases, )
+
+    def __dealloc__(self):
+        free(self._best_positions)
+        free(self._best_scores)
+
+    cdef int _reserve_best(self, Py_ssize_t k) except -1:
+        if k <= self._capacity:
+            return 0
+        cdef Py_ssize_t* positions = <Py_ssize_t*> realloc(self._best_positions, k * sizeof(Py_ssize_t))
+        if not positions:
+            raise MemoryError()
+        self._best_positions = positions
+        cdef double* scores = <double*> realloc(self._best_scores, k * sizeof(double))
+        if not scores:
+            raise MemoryError()
+        self._best_scores = scores
+        self._capacity = k
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def top_k(self, str target not None, Py_ssize_t k=1, double threshold=0.0, bint winkler=False,
+              double prefix_scale=0.1, positions=None):
+        """
+        Best k (position, score) pairs for target among the aliases (or the given `positions` of them).
+        """
+        if k <= 0:
+            return []
+
+        cdef Text t = text_of(target)
+        cdef Text text = self._text
+        cdef const long long[::1] offsets = self._offsets
+        cdef Py_ssize_t size = self._size
+
+        cdef const long long[::1] candidates
+        cdef bint every = positions is None
+        cdef Py_ssize_t count = size
+        cdef Py_ssize_t i
+        if not every:
+            if isinstance(positions, (list, tuple)):
+                candidates = array('q', positions)
+            else:
+                candidates = positions
+            count = candidates.shape[0]
+            for i in range(count):
+                if not 0 <= candidates[i] < size:
+                    raise IndexError(f'alias position {candidates[i]} out of range')
+
+        self._scratch.reserve(max(t.length, 1))
+        self._reserve_best(k)
+
+        cdef unsigned char* hash_a = self._scratch.hash_a
+        cdef unsigned char* hash_b = self._scratch.hash_b
+        cdef Py_ssize_t* best_positions = self._best_positions
+        cdef double* best_scores = self._best_scores
+        cdef Py_ssize_t found = 0
+        cdef Py_ssize_t scored = 0
+        cdef Py_ssize_t p, j
+        cdef Text alias
+        cdef double bound, score
+
+        with nogil:
+            for i in range(count):
+                p = i if every else candidates[i]
+                alias = slice_of(text, offsets[p], offsets[p + 1])
+
+                # Slack for rounding, the bound only has to be an upper bound on the score as computed.
+                bound = _jaro_bound(<int> t.length, <int> alias.length) + 1e-9
+                if winkler:
+                    bound = bound + 4 * prefix_scale * (1.0 - bound) + 1e-9
+                if bound < threshold or (found == k and bound < best_scores[k - 1]):
+                    continue
+
+                scored += 1
+                score = _jaro_distance(t, alias, hash_a, hash_b)
+                if winkler:
+                    score = _winkler(score, t, alias, prefix_scale)
+                if score < threshold:
+                    continue
+
+                # Insert into the best list, kept sorted by score then position.
+                j = found if found < k else k - 1
+                if found == k and not (score > best_scores[j] or (score == best_scores[j] and p < best_positions[j])):
+                    continue
+                while j > 0 and (score > best_scores[j - 1] or (score == best_scores[j - 1] and p < best_positions[j - 1])):
+                    best_scores[j] = best_scores[j - 1]
+                    best_positions[j] = best_positions[j - 1]
+                    j -= 1
+                best_scores[j] = score
+                best_positions[j] = p
+                if found < k:
+                    found += 1
+
+        self.searches += 1
+        self.scored += scored
+        return [(best_positions[i], best_scores[i]) for i in range(found)]